@@ -1,14 +1,32 @@
 import time
+import hashlib
+import signal
+import asyncio
 import logging
+import argparse
+import threading
 from isg_mysensors_constants import *
 from isg_mysensors_config import ISGConfig
 from isg_mysensors_modbus import modbus
 from isg_mysensors_mqtt import ISGmqtt
 from isg_mysensors_http import http
+from isg_mysensors_scheduler import scheduler
+from isg_mysensors_writer import write_queue
+from isg_mysensors_router import topic_router
+from isg_mysensors_requests import request_batch
+from isg_mysensors_state import state_store
+from isg_mysensors_history import sample_ring
+from isg_mysensors_supervisor import component_supervisor
 
 # TODO: Drop config stuff - build as constants in a constants module
 
 
+# A short fingerprint of everything a sensor was configured from - saved so a warm restart can tell
+# which sensors are new or have changed since they were presented
+def sensor_digest(in_sensor):
+    return hashlib.md5(repr(in_sensor.signature).encode()).hexdigest()
+
+
 # ----------------------------------------------------------------
 #
 # This class refreshes its values on an "as-needed" basis.
@@ -21,88 +39,665 @@ class ISGReader:
     def __init__(self, in_config_filename):
         logger.debug(f"ISGReader __init__ {in_config_filename}")
 
+        self.config_filename = in_config_filename
         self.config = ISGConfig(in_config_filename, logger)
-        reg_num_list = self.config.refresh_config()
-
-        self.modbus_client = modbus(self.config.modbus_host, int(self.config.modbus_port), logger)
-        self.modbus_client.build_blocks(reg_num_list)
-
-        self.http_reader = http(self.config.modbus_host, logger)
+        self.modbus_registers = self.config.refresh_config()
+
+        self.modbus_client = modbus(self.config.modbus_host, int(self.config.modbus_port), logger,
+                                    self.config.modbus_client_type, self.config.modbus_timeout,
+                                    self.config.modbus_pipeline_depth, self.config.reconnect_delay,
+                                    self.config.reconnect_max_delay)
+        self.modbus_client.build_blocks(self.modbus_registers, self.config.block_gap_cost,
+                                        self.config.block_max_length)
+
+        self.writer = write_queue(self.modbus_client, logger, self.config.write_debounce, self.config.write_verify)
+
+        self.http_reader = http(self.config.modbus_host, logger, self.config.http_timeout,
+                                self.config.http_retries, self.config.http_pool_size)
+        self.http_reader.build_pages(self.config.http_registers())
+
+        # The recent history of each sensor is recorded and the derived sensors worked out again
+        # whenever a block or page is read
+        self.history = {}
+        self.map_sensors()
+        self.modbus_client.on_refresh = self.blocks_refreshed
+        self.modbus_client.on_stale = self.blocks_stale
+        self.http_reader.on_refresh = self.page_refreshed
+
+        # The derived sensors' values and when they were worked out, and the input values they were worked from
+        # Blocks and pages can be read on different threads so they are worked out one thread at a time
+        self.derived_values = {}
+        self.derived_times = {}
+        self.input_values = {}
+        self.derived_lock = threading.Lock()
 
         self.last_values = {}
+        self.last_publish_times = {}
+
+        self.scheduler = scheduler(logger, ENGINE_LOOP)
+        self.schedule_sensors(time.time())
+        # The schedulers the running engine publishes from - their due times are what is saved
+        self.schedulers = [self.scheduler]
+        # When each sensor was due in the saved state - for an engine with schedulers of its own
+        self.restored_schedule = {}
+
+        self.requests = request_batch(logger, self.config.request_window)
+
+        self.router = topic_router(logger)
+        self.add_routes()
+
+        # Pseudo sensor to when its programme is due to be read from the ISG and sent to the Controller
+        self.programmes_due = {}
+        # Sensor id to the signature it was presented with - only the sensors that are new or have changed
+        # since the saved state are presented after a warm restart
+        self.presented = {}
+
+        # Set by SIGHUP or a RELOAD request and acted on by the engine between sensors
+        self.reload_requested = False
+
+        # Failed components are restarted in-process and SIGTERM / SIGINT stop them cleanly
+        self.supervisor = component_supervisor(logger)
+        # Debug - the number of times round the poll loop before stopping, -1 is for ever
+        self.loops = self.config.loops
+
+        # Carry on from the saved state if there is a recent one
+        self.state = None
+        warm = False
+        if self.config.state_file:
+            self.state = state_store(self.config.state_file, logger, self.config.state_interval,
+                                     self.config.state_max_age)
+            warm = self.restore_state(self.state.load())
 
         if self.config.mqtt:
             self.mqtt_client = ISGmqtt(self.config.mqtt_section(), self.config.mysensors_section(), self.when_message,
-                                       self.config.sensorTypes, self.config.sensorNames, logger)
+                                       self.config.sensors, self.supervisor, logger, not warm)
+            if warm:
+                self.mqtt_client.present_sensors({sensor.id: sensor for sensor in self.config.sensors.values()
+                                                  if self.presented.get(sensor.id) != sensor_digest(sensor)})
+        self.presented = {sensor.id: sensor_digest(sensor) for sensor in self.config.sensors.values()}
 
         # Read the HC and DHW programmes from the ISG and send them to the controller in a special message
-        self.mqtt_client.send_control_message("HC", COMMAND_SET, self.http_reader.refresh_raw_values(1))
-        self.mqtt_client.send_control_message("DHW", COMMAND_SET, self.http_reader.refresh_raw_values(2))
+        # After a warm restart this is put off for "Programme delay" seconds so the restart isn't held up by
+        # the programme pages - a fetch that was already put off before the restart keeps its due time
+        current_time = time.time()
+        for pseudo_sensor in programmeBlocks.keys():
+            if pseudo_sensor not in self.programmes_due:
+                self.programmes_due[pseudo_sensor] = current_time + (self.config.programme_delay if warm else 0)
+        self.send_programmes(current_time)
+
+    # Each Modbus sensor knows the block it is read from and the sensors of each block and page are listed
+    # Sensors keep the history they have already recorded
+    def map_sensors(self):
+        logger.debug(f"ISGReader map_sensors")
+
+        self.block_sensors = {}
+        self.page_sensors = {}
+        history = {}
+        for sensor in self.config.sensors.values():
+            if sensor.source == SOURCE_MODBUS:
+                sensor.block = self.modbus_client.register_block[sensor.address]
+                self.block_sensors.setdefault(sensor.block, []).append(sensor.id)
+            if sensor.source == SOURCE_HTTP and sensor.address in self.http_reader.val_page:
+                self.page_sensors.setdefault(self.http_reader.val_page[sensor.address], []).append(sensor.id)
+            if self.config.history_size > 0:
+                ring = self.history.get(sensor.id)
+                if ring is None or ring.size != self.config.history_size:
+                    ring = sample_ring(self.config.history_size)
+                history[sensor.id] = ring
+        self.history = history
+
+    # Called from the SIGHUP handler or a RELOAD request - the reload itself is done by the engine
+    # between sensors so it never happens in the middle of a read
+    def request_reload(self):
+        self.reload_requested = True
+        if self.config.mqtt:
+            self.mqtt_client.wake()
+
+    # Called from the SIGTERM / SIGINT handler - the engine finishes what it is doing and closes down
+    def stop(self):
+        self.supervisor.stop()
+        if self.config.mqtt:
+            self.mqtt_client.wake()
+
+    # Reload the config if asked to and tell the Controller what changed
+    # Returns the added, removed and changed sensors or None if there was no reload
+    def reload_if_requested(self):
+        if not self.reload_requested:
+            return None
+        self.reload_requested = False
+
+        result = self.reload()
+        if result is not None and self.config.mqtt:
+            added, removed, changed = result
+            self.mqtt_client.send_control_message(PSEUDO_RELOAD, COMMAND_SET,
+                                                  {"added": added, "removed": removed, "changed": changed,
+                                                   "time": int(time.time())})
+        return result
+
+    # Parse the config file again and apply the differences without dropping any connection
+    # Only the Modbus blocks and web pages whose sensors changed are read again and only the new and
+    # changed sensors are presented and scheduled - the connection settings need a restart to change
+    # Returns the added, removed and changed sensors or None if the config couldn't be loaded
+    def reload(self):
+        logger.debug(f"ISGReader reload {self.config_filename}")
+
+        start_time = time.time()
+        try:
+            config = ISGConfig(self.config_filename, logger)
+            modbus_registers = config.refresh_config()
+        except Exception:
+            logger.exception(f"ISGReader reload failed - carrying on with the old config")
+            return None
+
+        old_config = self.config
+        old_sensors = old_config.sensors
+        sensors = config.sensors
+        added = sorted(sensors.keys() - old_sensors.keys())
+        removed = sorted(old_sensors.keys() - sensors.keys())
+        changed = sorted(sensor for sensor in sensors.keys() & old_sensors.keys()
+                         if sensors[sensor].signature != old_sensors[sensor].signature)
+
+        if (config.modbus_host, config.modbus_port) != (old_config.modbus_host, old_config.modbus_port):
+            logger.warning(f"ISGReader reload - changes to the ISG host or port need a restart")
+        for section in (mqttSection, mySensorsSection):
+            old_section = dict(old_config.config[section]) if old_config.config.has_section(section) else None
+            new_section = dict(config.config[section]) if config.config.has_section(section) else None
+            if new_section != old_section:
+                logger.warning(f"ISGReader reload - changes to [{section}] need a restart")
+
+        self.config = config
+        if modbus_registers != self.modbus_registers:
+            kept = self.modbus_client.rebuild_blocks(modbus_registers, config.block_gap_cost,
+                                                     config.block_max_length)
+            logger.info(f"ISGReader reload - {kept} of {len(self.modbus_client.block_raw)} Modbus blocks kept")
+        self.modbus_registers = modbus_registers
+        self.http_reader.rebuild_pages(config.http_registers())
+
+        for sensor in removed + changed:
+            self.scheduler.remove(sensor)
+            self.history.pop(sensor, None)
+            self.last_values.pop(sensor, None)
+            self.last_publish_times.pop(sensor, None)
+            self.derived_values.pop(sensor, None)
+            self.derived_times.pop(sensor, None)
+        self.map_sensors()
+
+        # The derived sensors are worked out again from scratch the next time their inputs are read
+        with self.derived_lock:
+            self.input_values = {}
+
+        current_time = time.time()
+        for sensor in added + changed:
+            self.schedule_sensor(self.scheduler, sensor, current_time)
+
+        self.writer.discard(removed)
+        self.writer.debounce = config.write_debounce
+        self.writer.max_delay = config.write_debounce * 5
+        self.writer.verify = config.write_verify
+        self.requests.window = config.request_window
+
+        self.router.routes = {}
+        self.add_routes()
+
+        if self.config.mqtt:
+            self.mqtt_client.present_sensors({sensor: sensors[sensor] for sensor in added + changed})
+        self.presented = {sensor.id: sensor_digest(sensor) for sensor in sensors.values()}
+
+        logger.info(f"ISGReader reload - {len(added)} added, {len(removed)} removed, {len(changed)} changed "
+                    f"in {(time.time() - start_time) * 1000:.0f}ms")
+        return added, removed, changed
+
+    # Returns True if the programme was sent
+    def send_programme(self, in_pseudo_sensor, in_block):
+        logger.debug(f"ISGReader send_programme {in_pseudo_sensor} {in_block}")
+
+        programme = self.http_reader.refresh_raw_values(in_block)
+        if programme is None:
+            logger.error(f"Could not read the {in_pseudo_sensor} programme from the ISG")
+            return False
+
+        self.mqtt_client.send_control_message(in_pseudo_sensor, COMMAND_SET, programme)
+        return True
+
+    # Send the programmes that are due - one that can't be read is tried again after "Programme delay"
+    # Returns when the next programme is due or None once they have all been sent
+    def send_programmes(self, in_time):
+        for pseudo_sensor, due_time in list(self.programmes_due.items()):
+            if due_time > in_time:
+                continue
+            if self.send_programme(pseudo_sensor, programmeBlocks[pseudo_sensor]):
+                del self.programmes_due[pseudo_sensor]
+            else:
+                self.programmes_due[pseudo_sensor] = in_time + self.config.programme_delay
+        return min(self.programmes_due.values(), default=None)
+
+    # Everything needed to carry on after a restart - the caches, what was last published and when,
+    # when each sensor is next due, which programmes are still to be sent and what has been presented
+    def collect_state(self):
+        return {"modbus": self.modbus_client.cache_state(),
+                "http": self.http_reader.cache_state(),
+                "last_values": {str(sensor): value for sensor, value in self.last_values.items()},
+                "last_publish_times": {str(sensor): publish_time
+                                       for sensor, publish_time in self.last_publish_times.items()},
+                "schedule": {str(sensor): due_time for sensor_scheduler in self.schedulers
+                             for sensor, due_time in dict(sensor_scheduler.due_times).items()},
+                "programmes_due": dict(self.programmes_due),
+                "presented": {str(sensor): digest for sensor, digest in self.presented.items()}}
+
+    # Returns True if there was a state to carry on from
+    def restore_state(self, in_state):
+        logger.debug(f"ISGReader restore_state {in_state is not None}")
+
+        if in_state is None:
+            return False
+
+        blocks = self.modbus_client.restore_cache(in_state.get("modbus", []))
+        self.http_reader.restore_cache(in_state.get("http", {}))
+
+        # Sensors that have gone from the config since the state was saved are dropped
+        sensors = self.config.sensors
+        self.last_values.update({int(sensor): value for sensor, value in in_state.get("last_values", {}).items()
+                                 if int(sensor) in sensors})
+        self.last_publish_times.update({int(sensor): publish_time
+                                        for sensor, publish_time in in_state.get("last_publish_times", {}).items()
+                                        if int(sensor) in sensors})
+        self.restored_schedule = {int(sensor): due_time for sensor, due_time in in_state.get("schedule", {}).items()
+                                  if int(sensor) in sensors}
+        for sensor, due_time in self.restored_schedule.items():
+            self.scheduler.push(sensor, due_time)
+        self.programmes_due.update({pseudo_sensor: due_time
+                                    for pseudo_sensor, due_time in in_state.get("programmes_due", {}).items()
+                                    if pseudo_sensor in programmeBlocks})
+        self.presented = {int(sensor): digest for sensor, digest in in_state.get("presented", {}).items()}
+
+        logger.info(f"ISGReader warm restart - {blocks} Modbus blocks and "
+                    f"{len(self.last_values)} published values restored")
+        return True
+
+    def save_state(self):
+        if self.state is not None:
+            self.state.save(self.collect_state())
+
+    # Save the state if the periodic save is due
+    def save_state_if_due(self, in_time):
+        if self.state is not None and self.state.save_due(in_time):
+            self.save_state()
+
+    # Every sensor is published straight away and then either every "Publish interval" seconds
+    # or at its wall clock "Publish time"
+    def schedule_sensors(self, in_first_time):
+        logger.debug(f"ISGReader schedule_sensors {in_first_time}")
+
+        for sensor in self.config.sensors.keys():
+            self.schedule_sensor(self.scheduler, sensor, in_first_time)
+
+    def schedule_sensor(self, in_scheduler, in_sensor, in_first_time):
+        sensor = self.config.sensors[in_sensor]
+        if sensor.publish_time is not None:
+            in_scheduler.add_publish_time(in_sensor, sensor.publish_time, in_first_time)
+        elif sensor.interval is not None:
+            in_scheduler.add_interval(in_sensor, sensor.interval, in_first_time)
 
     def close_client(self):
         logger.debug(f"ISGReader close_client")
+        self.save_state()
         self.modbus_client.run_close()
+        self.http_reader.run_close()
         self.mqtt_client.run_stop()
 
+    # The value of a sensor as it is in the caches - nothing is read from the ISG
+    def cached_value(self, in_sensor):
+        sensor = self.config.sensors[in_sensor]
+        if sensor.source == SOURCE_DERIVED:
+            return self.derived_values.get(in_sensor)
+        if sensor.source == SOURCE_HTTP:
+            return sensor.value(self.http_reader.register_values.get(sensor.address))
+        return sensor.value(self.modbus_client.register_values.get(sensor.address))
+
+    def sensor_age(self, in_sensor):
+        sensor = self.config.sensors[in_sensor]
+        if sensor.source == SOURCE_DERIVED:
+            if in_sensor not in self.derived_times:
+                return None
+            return time.time() - self.derived_times[in_sensor]
+        if sensor.source == SOURCE_HTTP:
+            return self.http_reader.register_age(sensor.address)
+        return self.modbus_client.register_age(sensor.address)
+
+    # Only numbers are recorded - interval and text values have no sensible aggregates
+    def record_sample(self, in_sensor, in_time, in_value):
+        if isinstance(in_value, (int, float)) and in_sensor in self.history:
+            self.history[in_sensor].append(in_time, in_value)
+
+    def blocks_refreshed(self, in_blocks):
+        current_time = time.time()
+        values = {}
+        for block in in_blocks:
+            for sensor in self.block_sensors.get(block, []):
+                values[sensor] = self.cached_value(sensor)
+        self.sensors_refreshed(values, current_time)
+
+    # Tell the Controller which sensors are being served stale (or are fresh again) when their blocks change
+    def blocks_stale(self, in_blocks, in_stale):
+        if not self.config.mqtt:
+            return
+        sensors = self.config.sensors
+        self.mqtt_client.send_control_message(
+            PSEUDO_STALE, COMMAND_SET,
+            {"stale": in_stale, "time": int(time.time()),
+             "sensors": sorted(sensors[sensor].key for block in in_blocks
+                               for sensor in self.block_sensors.get(block, []) if sensor in sensors)},
+            f"{PSEUDO_STALE} {sorted(in_blocks)}")
+
+    def page_refreshed(self, in_page):
+        current_time = time.time()
+        values = {}
+        for sensor in self.page_sensors.get(in_page, []):
+            sensor_spec = self.config.sensors[sensor]
+            values[sensor] = sensor_spec.value(self.http_reader.decode_value(sensor_spec.address,
+                                                                             sensor_spec.real_type))
+        self.sensors_refreshed(values, current_time)
+
+    # Record the newly read values and work out the derived sensors whose inputs have changed
+    def sensors_refreshed(self, in_values, in_time):
+        changed = []
+        for sensor, value in in_values.items():
+            self.record_sample(sensor, in_time, value)
+            if sensor in self.config.derived.input_sensors and value != self.input_values.get(sensor):
+                self.input_values[sensor] = value
+                changed.append(sensor)
+
+        if changed:
+            self.update_derived(changed, in_time)
+
+    # Work out the derived sensors that depend on the changed sensors - a derived sensor that comes out
+    # the same doesn't cause the ones that depend on it to be worked out again
+    def update_derived(self, in_changed, in_time):
+        logger.debug(f"ISGReader update_derived {in_changed}")
+
+        with self.derived_lock:
+            changed = set(in_changed)
+            for derived in self.config.derived.affected(changed):
+                expression = self.config.sensors[derived].expression
+                if not changed & expression.inputs:
+                    continue
+                value = expression.evaluate({sensor: self.cached_value(sensor) for sensor in expression.inputs})
+                self.derived_times[derived] = in_time
+                self.record_sample(derived, in_time, value)
+                if value != self.derived_values.get(derived):
+                    self.derived_values[derived] = value
+                    changed.add(derived)
+
     # Fetches the value for the sensor
     def sensor_value(self, in_sensor):
         logger.debug(f"ISGReader sensor_value {in_sensor}")
 
-        if self.config.sensorRegisters[in_sensor][0:3] == "val":
-            reg_value = self.http_reader.register_value(self.config.sensorRegisters[in_sensor],
-                                                        self.config.sensorRefresh[in_sensor],
-                                                        self.config.registerDataTypes[in_sensor],
-                                                        self.config.sensorRealTypes[in_sensor])
-        else:
-            reg_value = self.modbus_client.register_value(int(self.config.sensorRegisters[in_sensor]),
-                                                          self.config.sensorRefresh[in_sensor],
-                                                          self.config.registerDataTypes[in_sensor],
-                                                          self.config.sensorRealTypes[in_sensor])
-        if self.config.sensorRealTypes[in_sensor] == 'bit':
-            return int(reg_value / pow(2, self.config.registerBit[in_sensor])) % 2
+        sensor = self.config.sensors[in_sensor]
+        if sensor.source == SOURCE_DERIVED:
+            # Worked out whenever its inputs are read
+            return self.derived_values.get(in_sensor)
+        elif sensor.source == SOURCE_HTTP:
+            reg_value = self.http_reader.register_value(sensor.address, sensor.refresh,
+                                                        sensor.data_type, sensor.real_type)
         else:
-            return reg_value
+            reg_value = self.modbus_client.register_value(sensor.address, sensor.refresh,
+                                                          sensor.data_type, sensor.real_type)
+        return sensor.value(reg_value)
+
+    def sensor_source(self, in_sensor):
+        return self.config.sensors[in_sensor].source
+
+    # True if the sensor's value is the last known one because its Modbus block could not be read
+    # A derived sensor is stale if any of the sensors it is worked out from are
+    def sensor_stale(self, in_sensor):
+        sensor = self.config.sensors[in_sensor]
+        if sensor.source == SOURCE_DERIVED:
+            return any(self.sensor_stale(leaf) for leaf in self.config.derived.leaves[in_sensor])
+        if sensor.source != SOURCE_MODBUS:
+            return False
+        return self.modbus_client.register_stale(sensor.address)
+
+    # The messages from the Controller that are handled and who handles them
+    def add_routes(self):
+        node_id = self.config.node_id
+        self.router.add_route("255", COMMAND_INTERNAL, I_DISCOVER_REQUEST, self.handle_discover)
+        self.router.add_route(node_id, COMMAND_INTERNAL, I_PRESENTATION, self.handle_presentation)
+        self.router.add_route(node_id, COMMAND_SET, None, self.handle_set)
+        self.router.add_route(node_id, COMMAND_REQ, None, self.handle_req)
+        self.router.add_route(node_id, COMMAND_REQ, V_CUSTOM, self.handle_custom_req)
+
+        # The special requests made by REQs of V_CUSTOM to a pseudo sensor
+        self.custom_requests = {PSEUDO_SNAPSHOT: self.send_snapshot,
+                                PSEUDO_STATS: self.send_stats,
+                                PSEUDO_RELOAD: lambda in_payload: self.request_reload()}
 
     # The callback for when a PUBLISH message is received from the server.
-    def when_message(self, msg_node_id, msg_sensor_id, msg_command, msg_type, payload):
-        logger.debug(f"ISGReader when_message {msg_node_id} {msg_sensor_id} {msg_command} {msg_type} {payload}")
-
-        # Process discover from Controller
-        if ((msg_node_id == "255") and
-           (msg_command == COMMAND_INTERNAL) and
-           (msg_type == I_DISCOVER_REQUEST)):
-            self.mqtt_client.discover_response()
-
-        # Process presentation request from Controller
-        elif ((msg_node_id == self.config.node_id) and
-              (msg_command == COMMAND_INTERNAL) and
-              (msg_type == I_PRESENTATION)):
-            self.mqtt_client.presentation(self.config.sensorTypes, self.config.sensorNames)
-
-        # Process set sensor value
-        elif ((msg_node_id == self.config.node_id) and
-              (msg_command == COMMAND_SET)):
-            self.set_sensor_value(msg_sensor_id, payload)
-
-        # Process request sensor value
-        elif ((msg_node_id == self.config.node_id) and
-              (msg_command == COMMAND_REQ)):
-            self.publish_value(int(msg_sensor_id))
-
-    # Publish the value of a sensor if it is different from the last value published
-    def publish_value(self, in_sensor):
-        logger.debug(f"ISGReader publish_value {in_sensor}")
+    def when_message(self, in_topic, in_payload):
+        logger.debug(f"ISGReader when_message {in_topic} {in_payload}")
+
+        self.router.route(in_topic, in_payload)
+
+    # The sensor_spec of a sensor id from a topic or None if it isn't one of ours
+    def known_sensor(self, in_sensor_id):
+        if not in_sensor_id.isdigit():
+            return None
+        return self.config.sensors.get(int(in_sensor_id))
+
+    # Process discover from Controller
+    def handle_discover(self, in_sensor_id, in_type, in_payload):
+        self.mqtt_client.discover_response()
+
+    # Process presentation request from Controller
+    def handle_presentation(self, in_sensor_id, in_type, in_payload):
+        self.mqtt_client.presentation(self.config.sensors)
+
+    # Process set sensor value - either a web page "valNNN" or one of our sensors
+    def handle_set(self, in_sensor_id, in_type, in_payload):
+        if in_sensor_id[0:3] != "val" and self.known_sensor(in_sensor_id) is None:
+            logger.warning(f"ISGReader handle_set unknown sensor {in_sensor_id}")
+            return
+        self.set_sensor_value(in_sensor_id, in_payload)
+
+    # Process request sensor value - it is answered with the rest of its batch
+    def handle_req(self, in_sensor_id, in_type, in_payload):
+        sensor = self.known_sensor(in_sensor_id)
+        if sensor is None:
+            logger.warning(f"ISGReader handle_req unknown sensor {in_sensor_id}")
+            return
+        self.requests.add(sensor.id, time.time())
+
+    # Process a special request - a sensor that is itself V_CUSTOM is just a normal REQ
+    def handle_custom_req(self, in_sensor_id, in_type, in_payload):
+        if in_sensor_id in self.custom_requests:
+            self.custom_requests[in_sensor_id](in_payload)
+        else:
+            self.handle_req(in_sensor_id, in_type, in_payload)
+
+    # Send the min / max / mean of a sensor's recent history
+    # The payload is "<sensor id>[,<window seconds>[,<number of latest samples>]]" - no window is all of the history
+    def send_stats(self, in_request):
+        logger.debug(f"ISGReader send_stats {in_request}")
+
+        fields = [field.strip() for field in in_request.split(",")]
+        sensor = self.known_sensor(fields[0])
+        try:
+            window = float(fields[1]) if len(fields) > 1 and fields[1] else None
+            last = int(fields[2]) if len(fields) > 2 and fields[2] else 0
+        except ValueError:
+            sensor = None
+        if sensor is None or sensor.id not in self.history:
+            logger.warning(f"ISGReader send_stats bad request {in_request}")
+            return
+
+        current_time = time.time()
+        stats = self.history[sensor.id].stats(None if window is None else current_time - window, last)
+        stats.update({"sensor": sensor.key, "window": window, "time": int(current_time)})
+        self.mqtt_client.send_control_message(PSEUDO_STATS, COMMAND_SET, stats, f"{PSEUDO_STATS} {in_request}")
+
+    # Send the cached value, age in seconds and staleness of every sensor (or those of the group
+    # named in the payload) in one message along with how late each schedule has been publishing
+    def send_snapshot(self, in_group):
+        logger.debug(f"ISGReader send_snapshot {in_group}")
+
+        group = in_group.strip() or None
+        snapshot = {}
+        for sensor in self.config.sensors.values():
+            if group is not None and sensor.group != group:
+                continue
+            age = self.sensor_age(sensor.id)
+            snapshot[sensor.key] = {"value": self.cached_value(sensor.id),
+                                    "age": None if age is None else round(age, 1),
+                                    "stale": self.sensor_stale(sensor.id)}
+
+        # Snapshots of different groups mustn't replace each other in the outbound queue
+        self.mqtt_client.send_control_message(PSEUDO_SNAPSHOT, COMMAND_SET,
+                                              {"group": group, "time": int(time.time()), "sensors": snapshot,
+                                               "jitter": self.jitter_stats()},
+                                              f"{PSEUDO_SNAPSHOT} {group}")
+
+    # How late the sensors have been published by each schedule - only the counters are read so this is
+    # safe from another thread
+    def jitter_stats(self):
+        return {sensor_scheduler.name: sensor_scheduler.jitter_stats() for sensor_scheduler in self.schedulers}
+
+    # Publish the value of a sensor if its publish policy says it has changed enough (or has been silent too long)
+    # in_force publishes any value that has been read - eg. to confirm a write
+    def publish_value(self, in_sensor, in_force=False):
+        logger.debug(f"ISGReader publish_value {in_sensor} {in_force}")
 
         new_value = self.sensor_value(in_sensor)
 
-        if in_sensor in self.last_values and new_value == self.last_values[in_sensor]:
+        # Nothing has been read for this sensor yet
+        if new_value is None:
+            return
+
+        if self.sensor_stale(in_sensor):
+            if self.config.stale_values == STALE_HOLD:
+                logger.debug(f"ISGReader publish_value holding stale value for {in_sensor}")
+                return
+            logger.debug(f"ISGReader publish_value serving stale value for {in_sensor}")
+
+        current_time = time.time()
+        sensor = self.config.sensors[in_sensor]
+        if not in_force and not sensor.policy.should_publish(
+                self.last_values.get(in_sensor), self.last_publish_times.get(in_sensor), new_value, current_time):
             return
 
         self.last_values[in_sensor] = new_value
+        self.last_publish_times[in_sensor] = current_time
         if self.config.mqtt:
-            self.mqtt_client.publish_value(str(in_sensor),
-                                           self.config.variableTypes[in_sensor],
-                                           new_value)
+            self.mqtt_client.publish_value(sensor, new_value)
+
+    # The sensors that are still configured - a sensor may have gone in a reload since it was due or requested
+    def configured(self, in_sensors):
+        sensors = self.config.sensors
+        return [sensor for sensor in in_sensors if sensor in sensors]
+
+    # When publishing has fallen in_lag seconds behind, put off the sensors that can wait - low priority ones
+    # past the lag threshold and normal ones past twice it - and try them again in_scheduler a lag threshold later
+    # rather than at their next turn, which for a wall clock "Publish time" is a day away, so those are never put off
+    # The rest are returned most important first
+    def shed_load(self, in_scheduler, in_sensors, in_lag):
+        in_sensors = self.configured(in_sensors)
+        sensors = self.config.sensors
+        threshold = self.config.lag_threshold
+        if in_lag > threshold * 2:
+            keep_rank = priorityRanks[PRIORITY_CRITICAL]
+        elif in_lag > threshold:
+            keep_rank = priorityRanks[PRIORITY_NORMAL]
+        else:
+            keep_rank = priorityRanks[PRIORITY_LOW]
+
+        kept = sorted((sensor for sensor in in_sensors
+                       if sensors[sensor].priority <= keep_rank or sensors[sensor].publish_time is not None),
+                      key=lambda sensor: sensors[sensor].priority)
+        if len(kept) < len(in_sensors):
+            deferred = sorted(set(in_sensors) - set(kept))
+            logger.warning(f"ISGReader shed_load {in_lag:.1f}s behind - deferred {deferred}")
+            retry_time = time.time() + threshold
+            for sensor in deferred:
+                if in_scheduler.due_times.get(sensor, retry_time) > retry_time:
+                    in_scheduler.push(sensor, retry_time)
+        return kept
+
+    # Publish a set of due sensors, first reading any stale Modbus blocks they need in one go
+    # In block publish mode the due Modbus sensors are grouped by block and when a block has to be
+    # refreshed every sensor in that block is published from the one read rather than just the due ones
+    # in_sources are the sources read here - the asyncio engine reads the others on their own threads first
+    def publish_sensors(self, in_sensors, in_sources=(SOURCE_MODBUS, SOURCE_HTTP)):
+        logger.debug(f"ISGReader publish_sensors {in_sensors} {in_sources}")
+
+        in_sensors = self.configured(in_sensors)
+        due_blocks, stale_blocks = self.refresh_sensors(in_sensors, in_sources)
+
+        if not self.config.block_publish:
+            for sensor in in_sensors:
+                self.publish_value(sensor)
+            return
+
+        sensors = self.config.sensors
+        for sensor in in_sensors:
+            if sensors[sensor].source != SOURCE_MODBUS:
+                self.publish_value(sensor)
+
+        for block, block_due in due_blocks.items():
+            if block in stale_blocks:
+                block_due = self.block_sensors[block]
+            for sensor in block_due:
+                self.publish_value(sensor)
+
+    # Read the stale Modbus blocks and web pages of a set of sensors with one read per block / page
+    # A derived sensor needs the blocks and pages of the sensors it is worked out from
+    # Only the blocks and pages of in_sources are read so each source can be read on its own thread
+    # Returns the due Modbus sensors grouped by block and the blocks that were read
+    def refresh_sensors(self, in_sensors, in_sources=(SOURCE_MODBUS, SOURCE_HTTP)):
+        sensors = self.config.sensors
+        due_blocks = {}
+        read_blocks = {}
+        due_vals = []
+        for sensor in in_sensors:
+            if sensors[sensor].source == SOURCE_MODBUS:
+                due_blocks.setdefault(sensors[sensor].block, []).append(sensor)
+            for read_sensor in self.config.derived.leaves.get(sensor, (sensor,)):
+                if sensors[read_sensor].source == SOURCE_MODBUS:
+                    read_blocks.setdefault(sensors[read_sensor].block, []).append(read_sensor)
+                else:
+                    due_vals.append(sensors[read_sensor].address)
+
+        # Read all of the stale blocks for this tick together so the reads can be pipelined
+        stale_blocks = []
+        if SOURCE_MODBUS in in_sources:
+            stale_blocks = [block for block, block_due in read_blocks.items()
+                            if self.modbus_client.block_stale(block, min(
+                                self.modbus_client.effective_refresh(sensors[sensor].address, sensors[sensor].refresh)
+                                for sensor in block_due))]
+            self.modbus_client.refresh_blocks(stale_blocks)
+
+        # Likewise fetch the stale web pages in parallel
+        if SOURCE_HTTP in in_sources:
+            self.http_reader.refresh_stale_pages(due_vals)
+
+        return due_blocks, stale_blocks
+
+    # The sources read for a set of sensors - a derived sensor is read from the sources of its leaves
+    def leaf_sources(self, in_sensors):
+        sensors = self.config.sensors
+        return set(sensors[leaf].source for sensor in in_sensors
+                   for leaf in self.config.derived.leaves.get(sensor, (sensor,)))
+
+    # Answer a set of REQs - every requested value is sent whatever its publish policy
+    def answer_sensors(self, in_sensors, in_sources=(SOURCE_MODBUS, SOURCE_HTTP)):
+        logger.debug(f"ISGReader answer_sensors {in_sensors} {in_sources}")
+
+        self.refresh_sensors(in_sensors, in_sources)
+        for sensor in in_sensors:
+            self.publish_value(sensor, True)
+
+    # Answer the batch of REQs if its window has closed
+    def answer_requests(self, in_time):
+        sensors = self.configured(self.requests.pop_due(in_time))
+        if sensors:
+            self.answer_sensors(sensors)
 
     def set_sensor_value(self, in_sensor_id, in_value):
         logger.debug(f"ISGReader set_sensor_value {in_sensor_id} {in_value}")
@@ -111,75 +706,127 @@ class ISGReader:
             self.http_reader.write_register(in_sensor_id, in_value)
 
         else:
-            sensor_id = int(in_sensor_id)
-            register = int(self.config.sensorRegisters[sensor_id])
-            if self.config.registerTypes[sensor_id] != "read/write":
-                logger.warning(f"Tried to write to non-writeable register {register} - sensor ID {sensor_id}")
+            sensor = self.config.sensors[int(in_sensor_id)]
+            if not sensor.writeable:
+                logger.warning(f"Tried to write to non-writeable register {sensor.address} - sensor ID {sensor.id}")
                 return 1
 
-            self.modbus_client.write_register(sensor_id, register, self.config.registerDataTypes[sensor_id], in_value)
-
-            self.publish_value(sensor_id)
-
-
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-f_handler = logging.FileHandler("/var/log/isg_mysensors/isgmysensors.log")
-f_handler.setLevel(logging.DEBUG)
-f_format = logging.Formatter("%(asctime)s:%(levelname)s: %(message)s")
-f_handler.setFormatter(f_format)
-logger.addHandler(f_handler)
-
-logger.info("ISG Reader started")
-
+            # The write is queued and the new value published once it has been written
+            self.writer.add(sensor.id, sensor.address,
+                            self.modbus_client.to_raw(sensor.data_type, in_value), time.time())
 
-ISG = ISGReader('isgmodbus.cfg')
+    # Make any queued writes that are due and publish the values written
+    def flush_writes(self, in_time):
+        for sensor in self.configured(self.writer.flush(in_time)):
+            self.publish_value(sensor, True)
 
-# print(ISG)
-# print(ISG.registerNameValue(507))
-# print(ISG.registerNameValue(536))
-# print(ISG.registerNameValue(2501))
-# print(ISG.registerNameValue(3515))
-# print(ISG.sensorRefresh)
+    # Time of the next thing the poll loop has to do - publish a sensor, make a write, answer REQs
+    # or send a programme
+    def next_due(self):
+        # None if there is nothing to do
+        return min((due for due in (self.scheduler.next_due(), self.writer.next_due(), self.requests.next_due(),
+                                    min(self.programmes_due.values(), default=None))
+                    if due is not None), default=None)
 
-time_to_publish = {}
 
-for sensor in ISG.config.sensorNames.keys():
+# Named rather than __name__ so it is the same logger when this is run as a script
+logger = logging.getLogger("isg_mysensors")
+logger.setLevel(logging.DEBUG)
 
-    previous_time = time.time() - 1
 
-    # This ensures every sensor is published straight away
-    time_to_publish[sensor] = previous_time
+# Log to in_log_file or to stderr if it is "-"
+def setup_logging(in_log_file):
+    if in_log_file == "-":
+        f_handler = logging.StreamHandler()
+    else:
+        f_handler = logging.FileHandler(in_log_file)
+    f_handler.setLevel(logging.DEBUG)
+    f_format = logging.Formatter("%(asctime)s:%(levelname)s: %(message)s")
+    f_handler.setFormatter(f_format)
+    logger.addHandler(f_handler)
 
-loops = ISG.config.loops
 
+# SIGTERM and SIGINT stop the daemon cleanly and SIGHUP reloads the config without a restart
+def install_signal_handlers(in_isg):
+    signal.signal(signal.SIGTERM, lambda in_signal, in_frame: in_isg.stop())
+    signal.signal(signal.SIGINT, lambda in_signal, in_frame: in_isg.stop())
+    signal.signal(signal.SIGHUP, lambda in_signal, in_frame: in_isg.request_reload())
 
-pause_time = 0
 
-while loops != 0:
-    logger.debug(f"In loop waiting for {pause_time} seconds")
+# The original single threaded engine - wait for MQTT messages until the next sensor is due and then publish
+# Returns when the debug loop count runs out or the daemon is stopping
+def poll_loop(in_isg):
+    logger.debug(f"poll_loop")
 
-    ISG.mqtt_client.run_loop(pause_time)
+    pause_time = 0
 
-    current_time = time.time()
+    while in_isg.loops != 0 and not in_isg.supervisor.stopping.is_set():
+        logger.debug(f"In loop waiting for {pause_time} seconds")
 
-    # This loop should ensure that pick up anything that falls into publish time
-    # while we are busy publishing other sensors
-    while min(time_to_publish.values()) <= current_time:
-        logger.debug(f"In loop current_time =  {current_time}")
+        in_isg.mqtt_client.run_loop(pause_time)
+        in_isg.reload_if_requested()
 
-        # Publish those that have reached their refresh interval
-        for sensor in ISG.config.sensorIntervals.keys():
-            if time_to_publish[sensor] <= current_time:
-                ISG.publish_value(sensor)
-                time_to_publish[sensor] = int(ISG.config.sensorIntervals[sensor]) + current_time
         current_time = time.time()
-
-    logger.debug(f"loop time_to_publish {time_to_publish}")
-    # This is failsafe in case we go negative - which causes loop to block
-    pause_time = max(min(time_to_publish.values()) - time.time(), 0)
-
-    if loops > 0:
-        loops -= 1
-
-ISG.close_client()
+        in_isg.flush_writes(current_time)
+        in_isg.answer_requests(current_time)
+        in_isg.save_state_if_due(current_time)
+        in_isg.send_programmes(current_time)
+
+        # This loop should ensure that pick up anything that falls into publish time
+        # while we are busy publishing other sensors
+        # but if the ISG is so slow that it can't catch up it goes back to the MQTT messages after the lag threshold
+        loop_start = current_time
+        while in_isg.scheduler.next_due() is not None and in_isg.scheduler.next_due() <= current_time:
+            logger.debug(f"In loop current_time =  {current_time}")
+
+            # Publish those that have reached their refresh interval - shedding the less important ones if behind
+            lag = in_isg.scheduler.lag(current_time)
+            in_isg.publish_sensors(in_isg.shed_load(in_isg.scheduler, in_isg.scheduler.pop_due(current_time), lag))
+            current_time = time.time()
+            if current_time - loop_start > in_isg.config.lag_threshold:
+                logger.warning(f"loop overran by {current_time - loop_start:.1f}s")
+                break
+
+        logger.debug(f"loop jitter {in_isg.scheduler.jitter_stats()}")
+        # This is failsafe in case we go negative - which causes loop to block
+        # With nothing to do (eg. a reload has left no sensors) just wait for messages
+        next_due = in_isg.next_due()
+        pause_time = max(next_due - time.time(), 0) if next_due is not None else idleLoopWait
+
+        if in_isg.loops > 0:
+            in_isg.loops -= 1
+
+
+# If the poll loop fails it is restarted straight away with the same ISGReader so nothing is lost
+def run_poll_loop(in_isg):
+    logger.debug(f"run_poll_loop")
+
+    install_signal_handlers(in_isg)
+    in_isg.supervisor.run("poll loop", poll_loop, in_isg)
+    in_isg.close_client()
+
+
+def main(in_args=None):
+    parser = argparse.ArgumentParser(description="Publish the values of a Stiebel Eltron ISG as a MySensors node")
+    parser.add_argument("--config", default=defaultConfigFile, help="the config file (default %(default)s)")
+    parser.add_argument("--log", default=defaultLogFile, help="the log file or - for stderr (default %(default)s)")
+    parser.add_argument("--engine", choices=(ENGINE_LOOP, ENGINE_ASYNC), default=ENGINE_LOOP,
+                        help="the single threaded poll loop or the asyncio engine (default %(default)s)")
+    args = parser.parse_args(in_args)
+
+    setup_logging(args.log)
+    logger.info(f"ISG Reader started - {args.config} {args.engine}")
+
+    isg = ISGReader(args.config)
+    if args.engine == ENGINE_ASYNC:
+        # Imported here as the async engine imports this module
+        from isg_mysensors_async import ISGAsyncEngine
+        asyncio.run(ISGAsyncEngine(isg).run())
+    else:
+        run_poll_loop(isg)
+
+    logger.info(f"ISG Reader stopped")
+
+
+if __name__ == "__main__":
+    main()
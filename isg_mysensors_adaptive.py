@@ -0,0 +1,31 @@
+#
+# This learns how often a register needs to be read from how often its value actually changes
+# Each read that finds the value changed shortens the register's refresh and each read that finds it
+# the same lengthens it, always within the sensor's Min refresh / Max refresh
+#
+
+# Multiplicative decrease on a change so a register that starts moving is soon read at its fastest again,
+# and a gentler increase so a slow register backs off over several reads
+DECREASE = 0.5
+INCREASE = 1.25
+
+
+class refresh_tracker:
+    def __init__(self, in_min_refresh, in_max_refresh, in_refresh=None):
+        self.min_refresh = in_min_refresh
+        self.max_refresh = in_max_refresh
+        self.refresh = in_min_refresh if in_refresh is None else min(max(in_refresh, in_min_refresh), in_max_refresh)
+        self.last_value = None
+
+    def __repr__(self):
+        return f"refresh_tracker({self.min_refresh}, {self.max_refresh}, {self.refresh})"
+
+    # Called with each newly read value - returns the refresh to use until the next read
+    def update(self, in_value):
+        if self.last_value is not None:
+            if in_value != self.last_value:
+                self.refresh = max(self.min_refresh, self.refresh * DECREASE)
+            else:
+                self.refresh = min(self.max_refresh, self.refresh * INCREASE)
+        self.last_value = in_value
+        return self.refresh
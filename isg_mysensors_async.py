@@ -0,0 +1,243 @@
+#
+# This is the asyncio engine - an alternative to the single threaded poll loop in isg_mysensors.py
+# Modbus polling, HTTP polling, the MQTT network loop and inbound commands run as independent tasks
+# and each I/O source has its own worker thread so a slow web page never delays a Modbus sensor or a SET
+#
+import asyncio
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from isg_mysensors_constants import *
+from isg_mysensors import logger, main
+from isg_mysensors_scheduler import scheduler
+
+
+class ISGAsyncEngine:
+    def __init__(self, in_isg):
+        logger.debug(f"ISGAsyncEngine __init__")
+
+        self.isg = in_isg
+        self.loop = None
+        self.commands = None
+        self.tasks = None
+
+        # One thread per source keeps the reads of a source in order without blocking the others
+        self.executors = {source: ThreadPoolExecutor(max_workers=1, thread_name_prefix=source)
+                          for source in (SOURCE_MODBUS, SOURCE_HTTP, SOURCE_MQTT)}
+
+        # Each poller has its own schedule of the sensors it reads
+        first_time = time.time()
+        self.schedulers = {SOURCE_MODBUS: scheduler(logger, SOURCE_MODBUS), SOURCE_HTTP: scheduler(logger, SOURCE_HTTP)}
+        for sensor in self.isg.config.sensors.keys():
+            self.isg.schedule_sensor(self.schedulers[self.sensor_thread(sensor)], sensor, first_time)
+        # Carry on with the schedule of a warm restart and save these schedules rather than the poll loop's
+        for sensor, due_time in self.isg.restored_schedule.items():
+            self.schedulers[self.sensor_thread(sensor)].push(sensor, due_time)
+        self.isg.schedulers = list(self.schedulers.values())
+
+    # The source whose thread a sensor is published on - derived sensors go with the Modbus sensors
+    # but any web pages they are worked out from are still fetched on the HTTP thread
+    def sensor_thread(self, in_sensor):
+        source = self.isg.sensor_source(in_sensor)
+        if source == SOURCE_DERIVED:
+            return SOURCE_MODBUS
+        return source
+
+    # Reads the blocks and pages of in_sensors that belong to other sources on those sources' threads
+    # so a derived sensor published on the Modbus thread never fetches a web page there
+    async def refresh_elsewhere(self, in_source, in_sensors):
+        for source in self.isg.leaf_sources(in_sensors) - {in_source}:
+            await self.run_in(source, self.isg.refresh_sensors, in_sensors, (source,))
+
+    async def run_in(self, in_source, in_function, *in_args):
+        try:
+            return await self.loop.run_in_executor(self.executors[in_source], in_function, *in_args)
+        except Exception:
+            logger.exception(f"ISGAsyncEngine {in_source} {in_function.__name__} failed")
+
+    async def poll(self, in_source):
+        logger.debug(f"ISGAsyncEngine poll {in_source}")
+
+        sensor_scheduler = self.schedulers[in_source]
+        while True:
+            # Sleep at most a second at a time so sensors added by a reload are picked up promptly
+            next_due = sensor_scheduler.next_due()
+            if next_due is None or next_due > time.time():
+                await asyncio.sleep(1.0 if next_due is None else min(next_due - time.time(), 1.0))
+                continue
+            current_time = time.time()
+            lag = sensor_scheduler.lag(current_time)
+            sensors = self.isg.shed_load(sensor_scheduler, sensor_scheduler.pop_due(current_time), lag)
+            await self.refresh_elsewhere(in_source, sensors)
+            await self.run_in(in_source, self.isg.publish_sensors, sensors, (in_source,))
+            logger.debug(f"ISGAsyncEngine poll {in_source} jitter {sensor_scheduler.jitter_stats()}")
+
+    # Makes the queued Modbus writes - on the Modbus thread so they are ordered with the reads
+    async def flush_writes(self):
+        logger.debug(f"ISGAsyncEngine flush_writes")
+
+        while True:
+            next_write = self.isg.writer.next_due()
+            if next_write is None:
+                await asyncio.sleep(self.isg.writer.debounce or 0.1)
+            else:
+                await asyncio.sleep(max(next_write - time.time(), 0))
+            await self.run_in(SOURCE_MODBUS, self.isg.flush_writes, time.time())
+
+    # Answers each batch of REQs - the sensors of each source are read and answered on that source's thread
+    async def answer_requests(self):
+        logger.debug(f"ISGAsyncEngine answer_requests")
+
+        while True:
+            next_batch = self.isg.requests.next_due()
+            if next_batch is None:
+                await asyncio.sleep(self.isg.requests.window or 0.1)
+                continue
+            await asyncio.sleep(max(next_batch - time.time(), 0))
+
+            sources = {}
+            for sensor in self.isg.configured(self.isg.requests.pop_due(time.time())):
+                sources.setdefault(self.sensor_thread(sensor), []).append(sensor)
+            await asyncio.gather(*[self.answer_sensors(source, sensors) for source, sensors in sources.items()])
+
+    async def answer_sensors(self, in_source, in_sensors):
+        await self.refresh_elsewhere(in_source, in_sensors)
+        await self.run_in(in_source, self.isg.answer_sensors, in_sensors, (in_source,))
+
+    # Saves the state periodically - on the Modbus thread so the block caches aren't being read into
+    async def save_state(self):
+        logger.debug(f"ISGAsyncEngine save_state")
+
+        while self.isg.state is not None:
+            await asyncio.sleep(self.isg.state.interval)
+            await self.run_in(SOURCE_MODBUS, self.isg.save_state)
+
+    # Sends the HC and DHW programmes that were put off by a warm restart - on the HTTP thread
+    # as they are read from web pages - only the HTTP thread changes programmes_due once this has started
+    # so it hands back when the next one is due rather than this reading it from the event loop
+    async def send_programmes(self):
+        logger.debug(f"ISGAsyncEngine send_programmes")
+
+        next_due = min(list(self.isg.programmes_due.values()), default=None)
+        while next_due is not None:
+            await asyncio.sleep(max(next_due - time.time(), 0))
+            next_due = await self.run_in(SOURCE_HTTP, self.isg.send_programmes, time.time())
+
+    # Runs on a source's thread - tells the engine the thread is parked and waits until it is released
+    def park(self, in_parked, in_released):
+        self.loop.call_soon_threadsafe(in_parked.set_result, None)
+        in_released.wait()
+
+    # Reloads the config when asked to - on the Modbus thread once the HTTP and MQTT threads are parked
+    # so nothing reads the blocks, pages or sensors while they are rebuilt - then reschedules the sensors
+    # that were added or changed
+    async def reload_config(self):
+        logger.debug(f"ISGAsyncEngine reload_config")
+
+        while True:
+            await asyncio.sleep(0.5)
+            if not self.isg.reload_requested:
+                continue
+
+            # The MQTT thread may be waiting in run_loop - wake it so it parks straight away
+            self.isg.mqtt_client.wake()
+            released = threading.Event()
+            parked = [self.loop.create_future() for _ in (SOURCE_HTTP, SOURCE_MQTT)]
+            held = [self.loop.run_in_executor(self.executors[source], self.park, source_parked, released)
+                    for source, source_parked in zip((SOURCE_HTTP, SOURCE_MQTT), parked)]
+            try:
+                await asyncio.gather(*parked)
+                result = await self.run_in(SOURCE_MODBUS, self.isg.reload_if_requested)
+            finally:
+                released.set()
+            await asyncio.gather(*held)
+            if result is None:
+                continue
+
+            added, removed, changed = result
+            for sensor in removed + changed:
+                for sensor_scheduler in self.schedulers.values():
+                    sensor_scheduler.remove(sensor)
+            current_time = time.time()
+            for sensor in added + changed:
+                self.isg.schedule_sensor(self.schedulers[self.sensor_thread(sensor)], sensor, current_time)
+
+    # Runs the MQTT network loop - inbound messages are queued for the command task
+    async def mqtt_network(self):
+        logger.debug(f"ISGAsyncEngine mqtt_network")
+
+        while True:
+            await self.run_in(SOURCE_MQTT, self.isg.mqtt_client.run_loop, 1.0)
+
+    # Called from the MQTT thread in place of ISGReader.when_message
+    def queue_message(self, in_topic, in_payload):
+        self.loop.call_soon_threadsafe(self.commands.put_nowait, (in_topic, in_payload))
+
+    # Work out which source's thread should handle a message so it is ordered with that source's reads
+    # REQs are only added to the batch so they stay on the MQTT thread
+    def message_source(self, in_sensor_id, in_command):
+        if in_command == COMMAND_SET:
+            if in_sensor_id[0:3] == "val":
+                return SOURCE_HTTP
+            sensor = self.isg.known_sensor(in_sensor_id)
+            if sensor is not None:
+                return self.sensor_thread(sensor.id)
+        return SOURCE_MQTT
+
+    # Commands are handed to their source's thread without waiting so one slow command doesn't block the next
+    async def handle_commands(self):
+        logger.debug(f"ISGAsyncEngine handle_commands")
+
+        while True:
+            topic, payload = await self.commands.get()
+            message = self.isg.router.parse(topic)
+            if message is None:
+                continue
+            source = self.message_source(message[1], message[2])
+            asyncio.ensure_future(self.run_in(source, self.isg.router.dispatch, message, payload))
+
+    # Called from the SIGTERM / SIGINT handler - the tasks are cancelled and the clients closed
+    def stop(self):
+        logger.debug(f"ISGAsyncEngine stop")
+
+        self.isg.stop()
+        if self.tasks is not None:
+            self.tasks.cancel()
+
+    async def run(self):
+        logger.debug(f"ISGAsyncEngine run")
+
+        self.loop = asyncio.get_running_loop()
+        self.commands = asyncio.Queue()
+        self.isg.mqtt_client.call_when_message = self.queue_message
+        self.loop.add_signal_handler(signal.SIGHUP, self.isg.request_reload)
+        self.loop.add_signal_handler(signal.SIGTERM, self.stop)
+        self.loop.add_signal_handler(signal.SIGINT, self.stop)
+
+        # Each task is restarted if it fails without disturbing the others
+        supervise = self.isg.supervisor.run_async
+        self.tasks = asyncio.gather(supervise("modbus poll", self.poll, SOURCE_MODBUS),
+                                    supervise("http poll", self.poll, SOURCE_HTTP),
+                                    supervise("flush writes", self.flush_writes),
+                                    supervise("answer requests", self.answer_requests),
+                                    supervise("save state", self.save_state),
+                                    supervise("send programmes", self.send_programmes),
+                                    supervise("reload config", self.reload_config),
+                                    supervise("mqtt network", self.mqtt_network),
+                                    supervise("handle commands", self.handle_commands))
+        try:
+            await self.tasks
+        except asyncio.CancelledError:
+            # Being stopped is a clean exit
+            if not self.isg.supervisor.stopping.is_set():
+                raise
+        finally:
+            for executor in self.executors.values():
+                executor.shutdown(wait=True)
+            self.isg.close_client()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] + ["--engine", ENGINE_ASYNC])
@@ -0,0 +1,63 @@
+#
+# This is the store and forward buffer for when the MQTT broker can't be reached
+# Sensor values sampled while disconnected are appended to a small SQLite database and
+# sent on in order, a batch at a time, once the broker is back - so no history is lost
+#
+import sqlite3
+import threading
+
+
+class sample_buffer:
+    def __init__(self, in_file_name, in_logger, in_max_rows=1000000):
+        in_logger.debug(f"sample_buffer __init__ {in_file_name} {in_max_rows}")
+
+        self.file_name = in_file_name
+        self.logger = in_logger
+        # Once the buffer is this full the oldest samples are dropped so an outage can't fill the disk
+        self.max_rows = in_max_rows
+        self.dropped = 0
+
+        # Samples are added by the publishing thread and sent by the MQTT sender thread
+        self.lock = threading.Lock()
+        self.database = sqlite3.connect(in_file_name, isolation_level=None, check_same_thread=False)
+        self.database.execute("PRAGMA journal_mode=WAL")
+        self.database.execute("CREATE TABLE IF NOT EXISTS samples "
+                              "(id INTEGER PRIMARY KEY AUTOINCREMENT, time REAL, sensor TEXT, value TEXT)")
+        self.rows = self.database.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+        if self.rows:
+            self.logger.info(f"sample_buffer {self.rows} samples still to send from {in_file_name}")
+
+    # Returns the id of the new sample so it can be removed again if it is sent live
+    def append(self, in_time, in_sensor, in_value):
+        with self.lock:
+            row_id = self.database.execute("INSERT INTO samples (time, sensor, value) VALUES (?, ?, ?)",
+                                           (in_time, in_sensor, str(in_value))).lastrowid
+            self.rows += 1
+            if self.rows > self.max_rows:
+                self.database.execute("DELETE FROM samples WHERE id = (SELECT MIN(id) FROM samples)")
+                self.rows -= 1
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    self.logger.warning(f"sample_buffer full - {self.dropped} of the oldest samples dropped")
+            return row_id
+
+    # The oldest in_count samples as (id, time, sensor, value)
+    def oldest(self, in_count):
+        with self.lock:
+            return self.database.execute("SELECT id, time, sensor, value FROM samples ORDER BY id LIMIT ?",
+                                         (in_count,)).fetchall()
+
+    # Remove the samples up to and including in_id once they have been sent
+    def remove_to(self, in_id):
+        with self.lock:
+            self.database.execute("DELETE FROM samples WHERE id <= ?", (in_id,))
+            self.rows = self.database.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+
+    # Remove a single sample - the latest value of a sensor that has been sent live after all
+    def remove(self, in_id):
+        with self.lock:
+            self.rows -= self.database.execute("DELETE FROM samples WHERE id = ?", (in_id,)).rowcount
+
+    def close(self):
+        with self.lock:
+            self.database.close()
@@ -4,6 +4,9 @@
 
 import configparser
 from isg_mysensors_constants import *
+from isg_mysensors_policy import publish_policy
+from isg_mysensors_sensor import sensor_spec
+from isg_mysensors_derived import derived_expression, derived_graph
 
 
 class ISGConfig:
@@ -20,20 +23,32 @@ class ISGConfig:
         self.node_id = self.config[mySensorsSection][mySensorsNodeID]
         self.modbus_host = self.config[serverSection][serverHost]
         self.modbus_port = int(self.config[serverSection][serverPort])
-
-        self.sensorNames = {}
-        self.registerTypes = {}
-        self.registerDataTypes = {}
-        self.sensorRealTypes = {}
-        self.registerBitValues = {}
-        self.registerBit = {}
-        self.sensorRefresh = {}
-        self.registerSensorIds = {}
-        self.sensorRegisters = {}
-        self.sensorTypes = {}
-        self.variableTypes = {}
-        self.sensorIntervals = {}
-        self.sensorPublishTimes = {}
+        self.block_gap_cost = float(self.config[serverSection].get(serverBlockGapCost, defaultBlockGapCost))
+        self.block_max_length = int(self.config[serverSection].get(serverBlockMaxLength, defaultBlockMaxLength))
+        self.block_publish = self.config[serverSection].getboolean(serverBlockPublish, False)
+        self.modbus_client_type = self.config[serverSection].get(serverClient, CLIENT_NATIVE)
+        self.modbus_timeout = float(self.config[serverSection].get(serverTimeout, 10))
+        self.modbus_pipeline_depth = int(self.config[serverSection].get(serverPipelineDepth, 4))
+        self.reconnect_delay = float(self.config[serverSection].get(serverReconnectDelay, 1))
+        self.reconnect_max_delay = float(self.config[serverSection].get(serverReconnectMaxDelay, 300))
+        self.stale_values = self.config[serverSection].get(serverStaleValues, STALE_SERVE)
+        self.http_timeout = float(self.config[serverSection].get(serverHttpTimeout, 10))
+        self.http_retries = int(self.config[serverSection].get(serverHttpRetries, 3))
+        self.http_pool_size = int(self.config[serverSection].get(serverHttpPoolSize, 4))
+        self.write_debounce = float(self.config[serverSection].get(serverWriteDebounce, 0.5))
+        self.write_verify = self.config[serverSection].getboolean(serverWriteVerify, False)
+        self.request_window = float(self.config[serverSection].get(serverRequestWindow, 0.2))
+        self.lag_threshold = float(self.config[serverSection].get(serverLagThreshold, 5))
+        self.state_file = self.config[serverSection].get(serverStateFile)
+        self.state_interval = float(self.config[serverSection].get(serverStateInterval, 300))
+        self.state_max_age = float(self.config[serverSection].get(serverStateMaxAge, 3600))
+        self.programme_delay = float(self.config[serverSection].get(serverProgrammeDelay, 300))
+        self.history_size = int(self.config[serverSection].get(serverHistorySize, 360))
+
+        # Sensor id to its compiled sensor_spec
+        self.sensors = {}
+        # The derived sensors in the order they are worked out
+        self.derived = None
 
         self.section_list = {}
 
@@ -61,31 +76,10 @@ class ISGConfig:
 
         for section in section_list:
             if int(self.config[section][sensorId]) >= 0:
-                sensor = int(self.config[section][sensorId])
-                register = self.config[section][registerAddress]
-                self.sensorRegisters[sensor] = register
-                self.sensorNames[sensor] = self.config[section][sensorName]
-                self.registerTypes[sensor] = self.config[section][registerType]
-                self.registerDataTypes[sensor] = int(self.config[section][registerDataType])
-                self.sensorRefresh[sensor] = int(self.config[section][sensorRefresh])
-                self.sensorRegisters[sensor] = register
-                self.sensorTypes[sensor] = self.config[section][sensorType]
-                self.variableTypes[sensor] = self.config[section][variableType]
-                if sensorPublishTime in self.config[section]:
-                    self.sensorPublishTimes[sensor] = self.config[section][sensorPublishTime]
-                elif sensorInterval in self.config[section]:
-                    self.sensorIntervals[sensor] = self.config[section][sensorInterval]
-
-                self.sensorRealTypes[sensor] = 'normal'
-                if registerLong in self.config[section]:
-                    self.sensorRealTypes[sensor] = 'long'
-                elif registerBit in self.config[section]:
-                    self.sensorRealTypes[sensor] = 'bit'
-                    self.registerBit[sensor] = int(self.config[section][registerBit])
-                elif register_interval in self.config[section]:
-                    self.sensorRealTypes[sensor] = 'interval'
-                elif register_idle in self.config[section]:
-                    self.sensorRealTypes[sensor] = 'idle'
+                sensor = self.compile_sensor(self.config[section])
+                self.sensors[sensor.id] = sensor
+
+        self.derived = derived_graph(self.sensors)
 
         if debugSection in self.config.sections():
             if debugLoops in self.config[debugSection]:
@@ -93,14 +87,120 @@ class ISGConfig:
 
         if mqttSection in self.config.sections():
             self.mqtt = True
-
-        # Clever way of getting a sorted integer list (from strings...)
-        # reg_num_list = [int(x) for x in [*self.sensorRegisters.values()]]  # Convert to integer list
-        reg_num_list = list(set(self.sensorRegisters.values()))
-        # reg_num_list.sort(key=int)  # Sort (in place)
-        reg_num_list.sort()  # Sort (in place)
-
-        return reg_num_list
+            for sensor in self.sensors.values():
+                sensor.set_topics(self.config[mqttSection][mqttPublish], self.node_id)
+
+        return self.modbus_registers()
+
+    # Work out everything about a sensor from its config section once
+    def compile_sensor(self, in_section):
+        self.logger.debug(f"config compile_sensor {in_section.name}")
+
+        register_type = in_section[registerType]
+        if registerTable in in_section:
+            table = in_section[registerTable]
+        elif register_type == "read/write":
+            table = TABLE_HOLDING
+        else:
+            table = TABLE_INPUT
+
+        bit = None
+        real_type = 'normal'
+        if registerLong in in_section:
+            real_type = 'long'
+        elif registerBit in in_section:
+            real_type = 'bit'
+            bit = int(in_section[registerBit])
+        elif register_interval in in_section:
+            real_type = 'interval'
+        elif register_idle in in_section:
+            real_type = 'idle'
+
+        priority = in_section.get(sensorPriority, PRIORITY_NORMAL)
+        if priority not in priorityRanks:
+            self.logger.warning(f"config sensor {in_section.name} has unknown priority {priority} - using normal")
+            priority = PRIORITY_NORMAL
+
+        expression = None
+        if sensorExpression in in_section:
+            expression = derived_expression(in_section[sensorExpression])
+
+        # A "Publish time" takes the place of the interval which is then not needed at all
+        interval = None
+        if sensorPublishTime not in in_section and sensorInterval in in_section:
+            interval = int(in_section[sensorInterval])
+
+        policy = publish_policy(float(in_section.get(sensorDeadband, 0)),
+                                float(in_section.get(sensorDeadbandPercent, 0)),
+                                float(in_section.get(sensorMinInterval, 0)),
+                                float(in_section.get(sensorHeartbeat, 0)))
+
+        sensor = sensor_spec(int(in_section[sensorId]), in_section[sensorName], in_section.get(registerAddress),
+                             register_type, table, int(in_section[registerDataType]), real_type, bit,
+                             int(in_section[sensorRefresh]), interval,
+                             in_section.get(sensorPublishTime), in_section.get(httpPage),
+                             in_section[sensorType], in_section[variableType], policy,
+                             in_section.get(sensorGroup), in_section.getboolean(sensorAdaptive, False),
+                             int(in_section[sensorMinRefresh]) if sensorMinRefresh in in_section else None,
+                             int(in_section[sensorMaxRefresh]) if sensorMaxRefresh in in_section else None,
+                             priority, expression)
+        sensor.signature = tuple(sorted(in_section.items()))
+        return sensor
+
+    # Build the details of each Modbus register needed for the block planner and decoding
+    # The period is how often the register is expected to be read - a register
+    # shared by several sensors takes the shortest period and widest width
+    # A register is only adaptive if all of its sensors are and then within the tightest bounds
+    def modbus_registers(self):
+        self.logger.debug(f"config modbus_registers")
+
+        registers = {}
+        for sensor in self.sensors.values():
+            if sensor.source != SOURCE_MODBUS:
+                continue
+
+            width = 2 if sensor.real_type == 'long' else 1
+            period = sensor.period()
+            adaptive = (sensor.min_refresh, sensor.max_refresh) if sensor.adaptive else None
+            register = registers.get(sensor.address)
+            if register is not None:
+                register["width"] = max(register["width"], width)
+                register["period"] = min(register["period"], period)
+                if register["adaptive"] is not None and adaptive is not None:
+                    register["adaptive"] = (min(register["adaptive"][0], adaptive[0]),
+                                            min(register["adaptive"][1], adaptive[1]))
+                else:
+                    register["adaptive"] = None
+            else:
+                registers[sensor.address] = {"width": width, "period": period, "table": sensor.table,
+                                             "data_type": sensor.data_type, "adaptive": adaptive}
+
+        return registers
+
+    # Build the details of each web page value - the "valNNN" name, its page and how often it is needed
+    # Values on the programme pages and the compressor idle time have default pages
+    def http_registers(self):
+        self.logger.debug(f"config http_registers")
+
+        registers = {}
+        for sensor in self.sensors.values():
+            if sensor.source != SOURCE_HTTP:
+                continue
+
+            details = {"refresh": sensor.refresh}
+            if sensor.page is not None:
+                details["page"] = sensor.page
+            elif sensor.real_type == 'idle':
+                details["page"] = IDLE_PAGE
+            else:
+                # Leave it to the built in pages
+                continue
+
+            if sensor.address in registers:
+                details["refresh"] = min(details["refresh"], registers[sensor.address]["refresh"])
+            registers[sensor.address] = details
+
+        return registers
 
     def mqtt_section(self):
         self.logger.debug(f"config mqtt_section")
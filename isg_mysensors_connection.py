@@ -0,0 +1,87 @@
+#
+# This supervises a connection that can fail - such as the Modbus link to the ISG
+# When the connection fails it is re-established in a background thread with exponential backoff
+# and jitter, and until then the circuit is open so callers fail fast instead of waiting on timeouts
+#
+import random
+import threading
+
+
+class connection_supervisor:
+    def __init__(self, in_name, in_connect, in_logger, in_base_delay=1.0, in_max_delay=300.0):
+        in_logger.debug(f"connection_supervisor __init__ {in_name} {in_base_delay} {in_max_delay}")
+
+        self.name = in_name
+        self.connect = in_connect
+        self.logger = in_logger
+        self.base_delay = in_base_delay
+        self.max_delay = in_max_delay
+
+        # Set while the connection is believed to be good (circuit closed)
+        self.connected = threading.Event()
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+        # Consecutive failures - only reset when the connection has been used successfully
+        # so a connection that accepts and then immediately fails keeps backing off
+        self.failures = 0
+
+    def available(self):
+        return self.connected.is_set()
+
+    # Try to connect straight away and fall back to background reconnection if that fails
+    def start(self):
+        self.logger.debug(f"connection_supervisor start {self.name}")
+
+        try:
+            self.connect()
+            self.connected.set()
+        except Exception as err:
+            self.logger.critical(f"Failed to connect to {self.name} - {err}")
+            self.report_failure()
+
+    def report_success(self):
+        self.failures = 0
+
+    # Open the circuit and start reconnecting in the background if not already doing so
+    # self.thread is only cleared by the reconnect thread once it has closed the circuit again
+    def report_failure(self):
+        self.logger.debug(f"connection_supervisor report_failure {self.name}")
+
+        with self.lock:
+            self.connected.clear()
+            self.failures += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.reconnect, name=f"{self.name} reconnect", daemon=True)
+                self.thread.start()
+
+    # Full jitter - a random delay up to the exponential backoff so reconnects don't synchronise
+    def backoff_delay(self):
+        return random.uniform(0, min(self.max_delay, self.base_delay * pow(2, self.failures - 1)))
+
+    def reconnect(self):
+        while not self.stopping.is_set():
+            delay = self.backoff_delay()
+            self.logger.info(f"Attempting to reconnect to {self.name} in {delay:.1f} seconds")
+            if self.stopping.wait(delay):
+                return
+
+            try:
+                self.connect()
+            except Exception as err:
+                self.logger.error(f"Failed to reconnect to {self.name} - {err}")
+                self.failures += 1
+                continue
+
+            # Closing the circuit and ending this thread together means a failure reported straight after
+            # the reconnect always starts a new thread rather than relying on this one that is finishing
+            self.logger.info(f"Reconnected to {self.name}")
+            with self.lock:
+                self.connected.set()
+                self.thread = None
+            return
+
+    def stop(self):
+        self.logger.debug(f"connection_supervisor stop {self.name}")
+        self.stopping.set()
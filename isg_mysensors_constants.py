@@ -11,6 +11,27 @@ debugLoops = 'Loops'
 serverSection = 'Server'
 serverHost = 'Host'
 serverPort = 'Port'
+serverBlockGapCost = 'Block gap cost'
+serverBlockMaxLength = 'Block max length'
+serverBlockPublish = 'Block publish'
+serverClient = 'Client'
+serverTimeout = 'Timeout'
+serverPipelineDepth = 'Pipeline depth'
+serverReconnectDelay = 'Reconnect delay'
+serverReconnectMaxDelay = 'Reconnect max delay'
+serverStaleValues = 'Stale values'
+serverHttpTimeout = 'Http timeout'
+serverHttpRetries = 'Http retries'
+serverHttpPoolSize = 'Http pool size'
+serverWriteDebounce = 'Write debounce'
+serverWriteVerify = 'Write verify'
+serverRequestWindow = 'Request window'
+serverLagThreshold = 'Lag threshold'
+serverStateFile = 'State file'
+serverStateInterval = 'State interval'
+serverStateMaxAge = 'State max age'
+serverProgrammeDelay = 'Programme delay'
+serverHistorySize = 'History size'
 
 mqttSection = 'MQTT'
 mqttHost = 'Host'
@@ -19,6 +40,11 @@ mqttKeepalive = 'Keepalive'
 mqttClient = 'Client name'
 mqttSubscribe = 'Subscribe topic'
 mqttPublish = 'Publish topic'
+mqttRateLimit = 'Rate limit'
+mqttBufferFile = 'Buffer file'
+mqttBufferBatch = 'Buffer batch'
+mqttBufferMaxRows = 'Buffer max rows'
+mqttReconnectMaxDelay = 'Reconnect max delay'
 
 mySensorsSection = 'MySensors'
 mySensorsGateway = 'Gateway name'
@@ -28,6 +54,8 @@ mySensorsNodeID = 'Node id'
 sensorName = 'Name'
 registerAddress = 'Address'
 registerType = 'Register type'
+registerTable = 'Table'
+httpPage = 'Page'
 registerDataType = 'Data type'
 registerBit = 'Bit'
 registerLong = 'Long'
@@ -39,12 +67,51 @@ sensorType = 'Sensor type'
 variableType = 'Variable type'
 sensorInterval = 'Publish interval'
 sensorPublishTime = 'Publish time'
+sensorDeadband = 'Deadband'
+sensorDeadbandPercent = 'Deadband percent'
+sensorMinInterval = 'Min publish interval'
+sensorHeartbeat = 'Heartbeat'
+sensorGroup = 'Group'
+sensorAdaptive = 'Adaptive'
+sensorMinRefresh = 'Min refresh'
+sensorMaxRefresh = 'Max refresh'
+sensorPriority = 'Priority'
+sensorExpression = 'Expression'
 
 registerTypes = {
         'read': 1,
         'read/write': 2
         }
 
+# Modbus register tables - read/write registers are holding registers unless the Table says otherwise
+TABLE_INPUT = 'input'
+TABLE_HOLDING = 'holding'
+
+# Modbus clients - the native client pipelines reads, easymodbus is the original one request at a time client
+CLIENT_NATIVE = 'native'
+CLIENT_EASYMODBUS = 'easymodbus'
+
+# What to do with values whose Modbus block could not be read - publish the last known value or hold it back
+STALE_SERVE = 'serve'
+STALE_HOLD = 'hold'
+
+# The engines that can run the daemon - the original single threaded poll loop or the asyncio engine
+ENGINE_LOOP = 'loop'
+ENGINE_ASYNC = 'async'
+
+# Where the daemon looks for its config and writes its log unless told otherwise on the command line
+defaultConfigFile = "isgmodbus.cfg"
+defaultLogFile = "/var/log/isg_mysensors/isgmysensors.log"
+
+# How long the poll loop waits for MQTT messages when it has nothing scheduled
+idleLoopWait = 60
+
+# Default cost of reading one register relative to the cost of a Modbus round trip
+# At 0.05 gaps of up to 20 unused registers are read rather than starting a new block
+defaultBlockGapCost = 0.05
+# Modbus allows at most 125 registers in a single read
+defaultBlockMaxLength = 125
+
 # Note that type 2 and 7 are signed
 # Types 6 and 8 are unsigned
 readMultiplier = {
@@ -54,6 +121,26 @@ readMultiplier = {
         8: 1
         }
 
+# The compressor idle time is on the heat pump status page unless the config gives a Page
+IDLE_PAGE = "?s=2,0"
+
+# Sensor priorities - when publishing falls behind low priority sensors are deferred first,
+# then normal ones, and critical ones are always published and published first
+PRIORITY_CRITICAL = 'critical'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_LOW = 'low'
+priorityRanks = {
+        PRIORITY_CRITICAL: 0,
+        PRIORITY_NORMAL: 1,
+        PRIORITY_LOW: 2
+        }
+
+# Where a sensor's value is read from
+SOURCE_MODBUS = 'modbus'
+SOURCE_HTTP = 'http'
+SOURCE_MQTT = 'mqtt'
+SOURCE_DERIVED = 'derived'
+
 # Command types from mySensors
 COMMAND_PRESENTATION = '0'
 COMMAND_SET = '1'
@@ -65,3 +152,19 @@ COMMAND_STREAM = '4'
 I_PRESENTATION = '19'
 I_DISCOVER_REQUEST = '20'
 I_DISCOVER_RESPONSE = '21'
+
+# Variable type used for the special messages to and from the Controller
+V_CUSTOM = '48'
+
+# The pseudo sensors the HC and DHW programmes are sent as and the programme blocks they are read from
+programmeBlocks = {
+        "HC": 1,
+        "DHW": 2
+        }
+
+# Pseudo sensors of the special messages
+PSEUDO_SNAPSHOT = 'SNAPSHOT'
+PSEUDO_HISTORY = 'HISTORY'
+PSEUDO_STATS = 'STATS'
+PSEUDO_RELOAD = 'RELOAD'
+PSEUDO_STALE = 'STALE'
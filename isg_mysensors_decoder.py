@@ -0,0 +1,68 @@
+#
+# This contains the compiled Modbus block decoders
+# Each block gets a decoder built once when the blocks are planned holding the offsets,
+# sign handling, multipliers and long pairs of its registers so that a raw block can be
+# converted to all of its engineering values in one call
+#
+from array import array
+from operator import itemgetter
+from isg_mysensors_constants import *
+
+# Types 2 and 7 are signed - see readMultiplier
+SIGNED_DATA_TYPES = (2, 7)
+
+
+# Returns a function that picks the values at in_offsets out of a block as a tuple in one C level call
+def gatherer(in_offsets):
+    if len(in_offsets) == 1:
+        offset = in_offsets[0]
+        return lambda in_values: (in_values[offset],)
+    return itemgetter(*in_offsets)
+
+
+class block_decoder:
+    # in_registers is a dictionary of register number to {"data_type", "width"} for the registers in the block
+    def __init__(self, in_start, in_registers):
+        self.start = in_start
+
+        # Registers are grouped by (signed, multiplier) so each group is gathered and scaled together
+        groups = {}
+        self.long_registers = []
+        for register in sorted(in_registers.keys()):
+            data_type = in_registers[register]["data_type"]
+            signed = data_type in SIGNED_DATA_TYPES
+            offset = register - in_start
+            if in_registers[register]["width"] == 2:
+                # The following register holds the thousands
+                self.long_registers.append((register, offset, signed, readMultiplier[data_type]))
+            else:
+                groups.setdefault((signed, readMultiplier[data_type]), []).append((register, offset))
+
+        self.groups = []
+        for (signed, multiplier), members in groups.items():
+            registers = tuple(register for register, _ in members)
+            offsets = [offset for _, offset in members]
+            self.groups.append((signed, multiplier, registers, gatherer(offsets)))
+
+    # Convert the raw block into a dictionary of register number to value
+    def decode(self, in_raw):
+        if not isinstance(in_raw, array):
+            in_raw = array('H', in_raw)
+        # Reinterpret the same memory as signed 16 bit values rather than converting one by one
+        signed_raw = memoryview(in_raw).cast('B').cast('h')
+
+        values = {}
+        for signed, multiplier, registers, gather in self.groups:
+            raw_values = gather(signed_raw if signed else in_raw)
+            if multiplier == 1:
+                values.update(zip(registers, raw_values))
+            else:
+                values.update(zip(registers, [round(raw_value * multiplier, 2) for raw_value in raw_values]))
+
+        for register, offset, signed, multiplier in self.long_registers:
+            net_value = (signed_raw if signed else in_raw)[offset] * multiplier + in_raw[offset + 1] * 1000
+            values[register] = int(net_value) if multiplier == 1 else round(net_value, 2)
+
+        signed_raw.release()
+
+        return values
@@ -0,0 +1,117 @@
+#
+# This contains the derived sensors - sensors whose value is an expression over other sensors
+# eg. "Expression = s3 - s1" for a delta-T or "(s10 + s11) / s14" for a COP
+# Each expression is checked and compiled once when the config is loaded and the derived sensors are
+# put in dependency order so when some inputs change only the sensors that depend on them are worked out again
+#
+import ast
+import re
+
+# Other sensors are referred to as s<sensor id>
+SENSOR_NAME = re.compile(r's(\d+)$')
+
+# The only functions an expression may call
+FUNCTIONS = {"abs": abs, "min": min, "max": max, "round": round}
+
+# The only kinds of syntax an expression may contain - arithmetic, comparisons and "a if condition else b"
+ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.IfExp, ast.BoolOp, ast.Call,
+                 ast.Name, ast.Load, ast.Constant,
+                 ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub, ast.UAdd,
+                 ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.And, ast.Or, ast.Not)
+
+
+class derived_expression:
+    def __init__(self, in_text):
+        self.text = in_text
+        self.inputs = set()
+
+        tree = ast.parse(in_text.strip(), mode='eval')
+        for node in ast.walk(tree):
+            if not isinstance(node, ALLOWED_NODES):
+                raise ValueError(f"Expression {in_text} - {type(node).__name__} is not allowed")
+            if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+                raise ValueError(f"Expression {in_text} - only numbers are allowed")
+            if isinstance(node, ast.Call) and (not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS
+                                               or node.keywords):
+                raise ValueError(f"Expression {in_text} - only {', '.join(FUNCTIONS)} can be called")
+            if isinstance(node, ast.Name) and node.id not in FUNCTIONS:
+                match = SENSOR_NAME.match(node.id)
+                if match is None:
+                    raise ValueError(f"Expression {in_text} - {node.id} is not a sensor")
+                self.inputs.add(int(match.group(1)))
+
+        self.code = compile(tree, f"<expression {in_text}>", 'eval')
+
+    def __repr__(self):
+        return f"derived_expression({self.text})"
+
+    # in_values is sensor id to value - None if any input has no value or the sum can't be done
+    # Results are rounded to 2 places like the values read from the ISG so float noise such as
+    # 2.8000000000000003 is neither published nor seen as a change
+    def evaluate(self, in_values):
+        names = dict(FUNCTIONS)
+        for sensor in self.inputs:
+            value = in_values.get(sensor)
+            if not isinstance(value, (int, float)):
+                return None
+            names[f"s{sensor}"] = value
+
+        try:
+            value = eval(self.code, {"__builtins__": {}}, names)
+        except (ArithmeticError, ValueError, TypeError):
+            return None
+
+        if isinstance(value, float):
+            return round(value, 2)
+        return value
+
+
+class derived_graph:
+    # in_sensors is the sensor id to sensor_spec of every sensor - the derived ones have an expression
+    def __init__(self, in_sensors):
+        self.inputs = {sensor.id: sensor.expression.inputs for sensor in in_sensors.values()
+                       if sensor.expression is not None}
+
+        # Sensor to the derived sensors that use it directly
+        self.dependents = {}
+        for derived, inputs in self.inputs.items():
+            for sensor in inputs:
+                if sensor not in in_sensors:
+                    raise ValueError(f"Derived sensor {derived} uses unknown sensor {sensor}")
+                self.dependents.setdefault(sensor, []).append(derived)
+
+        # Kahn's algorithm - each derived sensor comes after everything it uses
+        waiting = {derived: len(inputs & self.inputs.keys()) for derived, inputs in self.inputs.items()}
+        ready = sorted(derived for derived, count in waiting.items() if count == 0)
+        self.order = []
+        while ready:
+            derived = ready.pop(0)
+            self.order.append(derived)
+            for dependent in self.dependents.get(derived, []):
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    ready.append(dependent)
+        if len(self.order) != len(self.inputs):
+            raise ValueError(f"Derived sensors {sorted(set(self.inputs) - set(self.order))} depend on each other")
+
+        # The read sensors each derived sensor ultimately depends on - these are what have to be read for it
+        self.leaves = {}
+        for derived in self.order:
+            leaves = set()
+            for sensor in self.inputs[derived]:
+                leaves.update(self.leaves.get(sensor, {sensor}))
+            self.leaves[derived] = leaves
+
+        # The read sensors that any derived sensor uses
+        self.input_sensors = set().union(*self.leaves.values()) if self.leaves else set()
+
+    # The derived sensors that depend directly or indirectly on any of in_changed, in the order to work them out
+    def affected(self, in_changed):
+        affected = set()
+        pending = list(in_changed)
+        while pending:
+            for dependent in self.dependents.get(pending.pop(), []):
+                if dependent not in affected:
+                    affected.add(dependent)
+                    pending.append(dependent)
+        return [derived for derived in self.order if derived in affected]
@@ -0,0 +1,46 @@
+#
+# This keeps the recent history of a sensor in a fixed amount of memory
+# Each sensor has a ring of timestamps and values held in typed arrays so the Controller can ask
+# for the min / max / mean over a window rather than being sent every raw sample
+#
+from array import array
+
+
+class sample_ring:
+    def __init__(self, in_size):
+        self.size = in_size
+        self.times = array('d', bytes(8 * in_size))
+        self.values = array('d', bytes(8 * in_size))
+        # Where the next sample goes and how many of the slots have been filled
+        self.next = 0
+        self.count = 0
+
+    def append(self, in_time, in_value):
+        self.times[self.next] = in_time
+        self.values[self.next] = in_value
+        self.next = (self.next + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    # The samples from in_since (or all of them) as (time, value), oldest first
+    def samples(self, in_since=None):
+        first = (self.next - self.count) % self.size
+        samples = []
+        for index in range(self.count):
+            slot = (first + index) % self.size
+            if in_since is None or self.times[slot] >= in_since:
+                samples.append((self.times[slot], self.values[slot]))
+        return samples
+
+    def stats(self, in_since=None, in_last=0):
+        samples = self.samples(in_since)
+        if not samples:
+            return {"count": 0}
+
+        values = [value for _, value in samples]
+        return {"count": len(values),
+                "min": min(values),
+                "max": max(values),
+                "mean": round(sum(values) / len(values), 3),
+                "last": [[round(sample_time, 3), value] for sample_time, value in samples[-in_last:]]
+                if in_last > 0 else []}
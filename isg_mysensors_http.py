@@ -1,10 +1,14 @@
 #
-# This contains all of the modbus related functionality
+# This contains all of the http (ISG web page) related functionality
 #
+import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-import requests
-import pycurl
 from isg_mysensors_constants import *
+from isg_mysensors_http_session import http_session
+from isg_mysensors_http_parser import page_parser
+
+NUMBER = re.compile(r'-?\d+(?:[.,]\d+)?')
 
 
 def to_hhmm(in_minutes):
@@ -13,190 +17,242 @@ def to_hhmm(in_minutes):
     return f"{hours}:{minutes}"
 
 
+# Web page values are text such as "46,5" or "12min" - return the number if there is one
+def to_number(in_text):
+    match = NUMBER.search(in_text)
+    if match is None:
+        return in_text
+    number = match.group().replace(",", ".")
+    if "." in number:
+        return float(number)
+    return int(number)
+
+
 class http:
-    def __init__(self, in_host, in_logger):
-        in_logger.debug(f"http __init__ {in_host}")
+    def __init__(self, in_host, in_logger, in_timeout=10.0, in_retries=3, in_pool_size=4, in_retry_delay=10.0,
+                 in_retry_max_delay=300.0):
+        in_logger.debug(f"http __init__ {in_host} {in_timeout} {in_retries} {in_pool_size} {in_retry_delay} "
+                        f"{in_retry_max_delay}")
 
         self.logger = in_logger
         self.host = in_host
+        self.session = http_session(in_host, in_logger, in_timeout, in_retries, in_pool_size)
+        self.parser = page_parser()
+        # Stale pages of a cycle are fetched in parallel - one worker per pooled connection
+        self.executor = ThreadPoolExecutor(max_workers=in_pool_size, thread_name_prefix="http")
 
         # Blocks 1 and 2 are the HC and DHW programmes
         # Initially, these were defined as sensors but now they are loaded to block_raw,
         # serialised in JSON and then sent to the controller in a special message that
         # the controller understands and then writes to the database as a set of external
         # timed triggers so that they can be processed in the same way as the other programmes
-        # Note that block 3 is used for the compressor idle time (special case)
         self.block_raw = {}
-        self.block_page = {1: "?s=3,0", 2: "?s=3,1", 3: "?s=2,0"}
+        self.block_page = {1: "?s=3,0", 2: "?s=3,1"}
         # These are the "valNNN" names used in the web pages
         # Note that each entry contains a start time and an end time
-        self.block_start = {1: 130, 2: 172, 3: -1}
-        self.block_length = {1: 21, 2: 21, 3: 0}
+        self.block_start = {1: 130, 2: 172}
+        self.block_length = {1: 21, 2: 21}
+
+        # Every "valNNN" (and "validle") we know about is mapped to the page it is read from
+        # Each page has the values parsed from it, when it was read and how long that is good for
+        self.val_page = {}
+        self.page_values = {}
+        self.page_ttl = {}
         self.refresh_datetime = {}
         self.register_values = {}
-
-        # This can be run here as we don't need to read anything from the config
-        self.build_blocks()
-
-    # Note that http blocks are linked to pages
-    # In the page text they are "valNNN" and NNN is used as the register number
-    def build_blocks(self):
-        self.logger.debug(f"http build_blocks")
-
-        for cur_block in self.block_page.keys():
-            self.refresh_datetime[cur_block] = datetime.min  # Set as old as possible so always refreshed on first read
-
-    def get_block(self, in_register):
-        self.logger.debug(f"http get_block {in_register}")
-
-        block = -1
-
-        if in_register == "idle":
-            return 3
-
-        for cur_block in self.block_start.keys():
-            if ((in_register >= self.block_start[cur_block]) and
-                    (in_register < self.block_start[cur_block] + self.block_length[cur_block])):
-                block = cur_block
-
-        if block == -1:
+        # A page that couldn't be fetched isn't tried again until its retry time - the delay doubles with
+        # each failure so an outage of the web server doesn't stall every cycle on timeouts
+        self.retry_delay = in_retry_delay
+        self.retry_max_delay = in_retry_max_delay
+        self.page_failures = {}
+        self.retry_datetime = {}
+        # Called with the page whenever a page has been read - from the prefetch workers too
+        self.on_refresh = None
+
+        # The programme values can be read without being configured as sensors
+        self.build_pages(self.programme_vals())
+
+    def programme_vals(self):
+        return {f"val{self.block_start[block] + index}": {"page": self.block_page[block], "refresh": 86400}
+                for block in self.block_page.keys() for index in range(self.block_length[block])}
+
+    # in_vals is a dictionary of "valNNN" to {"page", "refresh"}
+    # Each page is refreshed as often as the most frequently needed value on it
+    def build_pages(self, in_vals):
+        self.logger.debug(f"http build_pages {in_vals}")
+
+        for val, details in in_vals.items():
+            page = details["page"]
+            self.val_page[val] = page
+            self.page_ttl[page] = min(self.page_ttl.get(page, details["refresh"]), details["refresh"])
+            if page not in self.refresh_datetime:
+                self.refresh_datetime[page] = datetime.min  # Set as old as possible so always refreshed on first read
+
+    # Map the values to pages again for a reloaded config - pages that are still used keep what was read
+    def rebuild_pages(self, in_vals):
+        self.logger.debug(f"http rebuild_pages {in_vals}")
+
+        self.val_page = {}
+        self.page_ttl = {}
+        self.build_pages(self.programme_vals())
+        self.build_pages(in_vals)
+
+        for page in list(self.refresh_datetime.keys()):
+            if page not in self.page_ttl:
+                del self.refresh_datetime[page]
+                self.page_values.pop(page, None)
+                self.page_failures.pop(page, None)
+                self.retry_datetime.pop(page, None)
+        for register in list(self.register_values.keys()):
+            if register not in self.val_page:
+                del self.register_values[register]
+
+    def get_page(self, in_register):
+        page = self.val_page.get(in_register)
+        if page is None:
             self.logger.error(f"Tried to read invalid register {in_register}")
-
-        return block
-
-    # Refresh just the block containing the register we are reading
+        return page
+
+    # Fetch and parse a page - this runs in the prefetch workers so it only touches its own page's entries
+    # If the page can't be fetched it keeps its old values and False is returned
+    def refresh_page(self, in_page):
+        self.logger.debug(f"http refresh_page {in_page}")
+
+        page_text = self.session.get_page(in_page)
+        if page_text is None:
+            failures = self.page_failures.get(in_page, 0) + 1
+            self.page_failures[in_page] = failures
+            delay = min(self.retry_max_delay, self.retry_delay * pow(2, failures - 1))
+            self.retry_datetime[in_page] = datetime.now() + timedelta(seconds=delay)
+            self.logger.warning(f"http could not read {in_page} - trying again in {delay:.0f} seconds")
+            return False
+
+        self.page_failures.pop(in_page, None)
+        self.retry_datetime.pop(in_page, None)
+        self.page_values[in_page] = self.parser.parse(page_text)
+        self.refresh_datetime[in_page] = datetime.now()
+        if self.on_refresh is not None:
+            self.on_refresh(in_page)
+
+        return True
+
+    # A page waiting to be retried after a failed read isn't stale until its retry time
+    def page_stale(self, in_page, in_refresh=None):
+        if in_refresh is None:
+            in_refresh = self.page_ttl[in_page]
+        now = datetime.now()
+        if now < self.retry_datetime.get(in_page, datetime.min):
+            return False
+        return now > (self.refresh_datetime[in_page] + timedelta(seconds=int(in_refresh)))
+
+    # Seconds since the page holding the register was last read or None if it never has been
+    def register_age(self, in_register):
+        refresh_datetime = self.refresh_datetime.get(self.val_page.get(in_register), datetime.min)
+        if refresh_datetime == datetime.min:
+            return None
+        return (datetime.now() - refresh_datetime).total_seconds()
+
+    # The parsed pages in a form that can be saved
+    def cache_state(self):
+        return {page: {"values": values, "read": self.refresh_datetime[page].timestamp()}
+                for page, values in self.page_values.items()}
+
+    def restore_cache(self, in_pages):
+        self.logger.debug(f"http restore_cache {len(in_pages)}")
+
+        for page, cache in in_pages.items():
+            if page in self.refresh_datetime:
+                self.page_values[page] = cache["values"]
+                self.refresh_datetime[page] = datetime.fromtimestamp(cache["read"])
+
+    # Fetch all of the stale pages holding the given registers in parallel
+    def refresh_stale_pages(self, in_registers):
+        self.logger.debug(f"http refresh_stale_pages {in_registers}")
+
+        pages = set(self.val_page[register] for register in in_registers if register in self.val_page)
+        self.refresh_pages([page for page in pages if self.page_stale(page)])
+
+    def refresh_pages(self, in_pages):
+        if len(in_pages) == 1:
+            self.refresh_page(in_pages[0])
+        elif in_pages:
+            list(self.executor.map(self.refresh_page, in_pages))
+
+    # Refresh a programme block and return the programme to be forwarded to the controller
+    # Returns None if the page could not be read
     def refresh_raw_values(self, in_block):
         self.logger.debug(f"http refresh_raw_values {in_block}")
 
-        request = f"http://{self.host}/{self.block_page[in_block]}"
-
-        page = requests.get(request, timeout=10)
-
-        while page.status_code != 200:
-            self.logger.error(f"http refresh_raw_values - http get failed: {request} {page.status_code} {page.reason}")
-            page = requests.get(request, timeout=60)
+        if not self.refresh_page(self.block_page[in_block]):
+            return None
 
-        start_val = self.block_start[in_block]
+        page_values = self.page_values[self.block_page[in_block]]
 
         # These are the lists of on / off pairs for the CH and DHW - 3 pairs per day
-        if in_block == 1 or in_block == 2:
-            text_pos = 0
-            # Whilst block_raw is populated (but is probably not used - no need to define sensors)
-            # programme will be returned to the caller and then forwarded to the controller in a special message
-            day = 0
-            programme = {}
-            # Walk through the page from start to end looking for appropriate text
-            while start_val < self.block_start[in_block] + self.block_length[in_block] - 1:
-                programme[day] = {}
-                text_pos += page.text[text_pos:].find(
-                    f'"val{start_val}","val{start_val + 1}","val{start_val + 2}"') + 27
-                text_pos += page.text[text_pos:].find(': [') + 3
-                end_bracket = text_pos + page.text[text_pos:].find(']')
-                # Finally reached the values themselves!!!
-                values = page.text[text_pos:end_bracket].split(",")
-                # Replace empty values with 128, which is recognised as empty by ISG
-                if len(values) < 2:
-                    self.block_raw[start_val] = ["32:00", "32:00"]
-                else:
-                    self.block_raw[start_val] = [f"{to_hhmm(int(values[0]) * 15)}", f"{to_hhmm(int(values[1]) * 15)}"]
-                programme[day][0] = self.block_raw[start_val]
-
-                if len(values) < 4:
-                    self.block_raw[start_val + 1] = ["32:00", "32:00"]
-                else:
-                    self.block_raw[start_val + 1] = [f"{to_hhmm(int(values[2]) * 15)}",
-                                                     f"{to_hhmm(int(values[3]) * 15)}"]
-                programme[day][1] = self.block_raw[start_val + 1]
-
-                if len(values) < 6:
-                    self.block_raw[start_val + 2] = ["32:00", "32:00"]
-                else:
-                    self.block_raw[start_val + 2] = [f"{to_hhmm(int(values[4]) * 15)}",
-                                                     f"{to_hhmm(int(values[5]) * 15)}"]
-                programme[day][2] = self.block_raw[start_val + 2]
-
-                start_val += 3
-                day += 1
-
-            return programme
-
-        elif in_block == 3:
-            text_pos = page.text.find('REMAINING IDLE TIME') + 18
-            if text_pos == -1:
-                self.block_raw["idle"] = "0min"
+        # Whilst block_raw is populated (but is probably not used - no need to define sensors)
+        # programme will be returned to the caller and then forwarded to the controller in a special message
+        programme = {}
+        for index in range(self.block_length[in_block]):
+            start_val = self.block_start[in_block] + index
+            values = page_values.get(f"val{start_val}", [])
+            # Replace empty values with 128, which is recognised as empty by ISG
+            if len(values) < 2:
+                self.block_raw[start_val] = ["32:00", "32:00"]
             else:
-                text_pos += page.text[text_pos:].find('<td class="value round-rightbottom">') + 36
-                end_pos = page.text[text_pos:].find('<') + text_pos
-                self.block_raw["idle"] = page.text[text_pos:end_pos]
-
-        self.refresh_datetime[in_block] = datetime.now()
-
-    # Only refresh the raw data if the register raw data is stale
-    def refresh_if_needed(self, in_register, in_refresh):
-        self.logger.debug(f"http refresh_if_needed {in_register} {in_refresh}")
-
-        block = self.get_block(in_register)
-
-        if datetime.now() > (self.refresh_datetime[block] + timedelta(seconds=int(in_refresh))):
-            self.refresh_raw_values(block)
-
-        return block
-
-    def refresh_net_value(self, in_register, in_refresh, in_register_type, in_type):
-        self.logger.debug(f"http refresh_net_value {in_register} {in_refresh} {in_register_type} {in_type}")
-
-        self.refresh_if_needed(in_register, in_refresh)
-        raw_value = self.block_raw[in_register]
+                self.block_raw[start_val] = [f"{to_hhmm(int(values[0]) * 15)}", f"{to_hhmm(int(values[1]) * 15)}"]
+            programme.setdefault(index // 3, {})[index % 3] = self.block_raw[start_val]
+
+        return programme
+
+    # Convert a value from its page as last read - returns the value or None if it isn't there
+    def decode_value(self, in_register, in_type):
+        page = self.val_page.get(in_register)
+        if page is None or page not in self.page_values:
+            return
+        raw_value = self.page_values[page].get(in_register)
+        if raw_value is None:
+            if in_type == 'idle':
+                raw_value = "0min"
+            else:
+                return
 
         if in_type == 'interval':
-            self.register_values[in_register] = \
-                f"[{to_hhmm(int(raw_value[0]) * 15)}, {to_hhmm(int(raw_value[1]) * 15)}]"
+            if len(raw_value) < 2:
+                self.register_values[in_register] = "[32:00, 32:00]"
+            else:
+                self.register_values[in_register] = \
+                    f"[{to_hhmm(int(raw_value[0]) * 15)}, {to_hhmm(int(raw_value[1]) * 15)}]"
         elif in_type == 'idle':
             self.register_values[in_register] = raw_value.split("min")[0]
+        else:
+            self.register_values[in_register] = to_number(raw_value)
 
-        return
+        return self.register_values[in_register]
 
+    # The stale pages are fetched by refresh_stale_pages before the values are asked for so this only
+    # converts the value from the page as last read - a page that couldn't be read isn't tried again here
     def register_value(self, in_register, in_refresh, in_reg_datatype, in_type):
         self.logger.debug(f"http register_value {in_register} {in_refresh} {in_reg_datatype} {in_type}")
 
-        num_reg = in_register[3:]
-        if in_type != "idle":
-            num_reg = int(num_reg)
-
-        #        print("registerValue " + str(inRegister) + " " + str(inRefresh))
-        self.refresh_net_value(num_reg, in_refresh, in_reg_datatype, in_type)
-        return self.register_values[num_reg]
+        if self.get_page(in_register) is not None:
+            self.decode_value(in_register, in_type)
+        return self.register_values.get(in_register)
 
     def write_register(self, in_sensor_val, in_value):
-
-        # TODO: This needs fixing up!
         self.logger.debug(f"http write_register {in_sensor_val} {in_value}")
 
-        # This is the only way I could get this working!
-        # I tried using urlencode, various forms of data but only this worked
-        # The equivalent curl command line is:
-        # curl http://servicewelt/save.php --trace-ascii /dev/stdout --data-urlencode 'data=[{"name":"val22","value":"46.5"}]'
-        # (trace turned on!)
-
-        http_connection = pycurl.Curl()
-        http_connection.setopt(http_connection.URL, 'http://servicewelt/save.php')
-        post_field = f'data=%5B%7B%22name%22%3A%22{in_sensor_val}%22%2C%22value%22%3A%22{in_value}%22%7D%5D'
-        self.logger.debug(f"http write_register {post_field}")
-        http_connection.setopt(http_connection.POSTFIELDS, post_field)
-        http_connection.perform()
-        http_connection.close()
-
-        register = int(in_sensor_val[3:])
-        block = -1
-        for index in self.block_start.keys():
-            if self.block_start[index] <= register < self.block_start[index] + self.block_length[index]:
-                block = index
-
-        if block > -1:
-            # TODO - update the raw data
-            # Make sure we update the raw data
-            # if register % 2 == 0:
-            # self.block_raw[start_val] = ["32:00", "32:00"]
-            pass
+        if not self.session.save_value(in_sensor_val, in_value):
+            return
+
+        # Make sure the page holding the value is read again rather than revalidated from the old copy
+        page = self.val_page.get(in_sensor_val)
+        if page is not None:
+            self.session.invalidate(page)
+            self.refresh_datetime[page] = datetime.min
+            self.retry_datetime.pop(page, None)
 
         return
+
+    def run_close(self):
+        self.logger.debug(f"http run_close")
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,65 @@
+#
+# This is the single pass parser for the ISG web pages
+# All of the patterns are compiled into one regular expression so a page is scanned once from start to end
+# and every "valNNN" value (and the compressor idle time) is picked up in that one scan
+#
+import re
+
+# The programme pages list the val names of a day followed by an array of their values, eg
+#   "val130","val131","val132" ... : [28,36,68,88]
+# Each val is an on / off pair so the array is shared out two values per val and missing pairs are left empty
+# The gap before the array is short and can't cross a tag or another quoted val name - otherwise a stray "valNNN"
+# would swallow everything up to the next array and each one would rescan the rest of the page
+PROGRAMME_PATTERN = r'(?P<names>"val\d+"(?:\s*,\s*"val\d+")*)(?:(?!"val\d)[^\[<>]){0,64}?:\s*\[(?P<values>[^\]]*)\]'
+
+# Single values held in form fields, with the name / id before or after the value
+INPUT_PATTERN = (r'<input[^>]*?\b(?:name|id)="(?P<input_name>val\d+)"[^>]*?\bvalue="(?P<input_value>[^"]*)"'
+                 r'|<input[^>]*?\bvalue="(?P<input_value_first>[^"]*)"[^>]*?\b(?:name|id)="(?P<input_name_last>val\d+)"')
+
+# The compressor idle time on the heat pump status page
+IDLE_PATTERN = r'REMAINING IDLE TIME.*?<td class="value round-rightbottom">(?P<idle>[^<]*)'
+
+VAL_NAME = re.compile(r'val\d+')
+
+
+def parse_programme(in_match, in_values):
+    names = VAL_NAME.findall(in_match.group("names"))
+    values = [value.strip() for value in in_match.group("values").split(",") if value.strip()]
+    for index, name in enumerate(names):
+        in_values[name] = values[index * 2:index * 2 + 2]
+
+
+def parse_input(in_match, in_values):
+    if in_match.group("input_name") is not None:
+        in_values[in_match.group("input_name")] = in_match.group("input_value")
+    else:
+        in_values[in_match.group("input_name_last")] = in_match.group("input_value_first")
+
+
+# This is stored as "validle" - the address used for it in the config
+def parse_idle(in_match, in_values):
+    in_values["validle"] = in_match.group("idle").strip()
+
+
+class page_parser:
+    def __init__(self):
+        # Each kind of pattern has a handler that stores what it matched
+        self.patterns = []
+        self.handlers = {}
+        self.add_pattern("programme", PROGRAMME_PATTERN, parse_programme)
+        self.add_pattern("input", INPUT_PATTERN, parse_input)
+        self.add_pattern("idle", IDLE_PATTERN, parse_idle)
+
+    # Further patterns can be added for other pages - the pattern's named groups are passed to the handler
+    # through the match and the handler adds whatever it finds to the values dictionary
+    def add_pattern(self, in_kind, in_pattern, in_handler):
+        self.patterns.append(f"(?P<kind_{in_kind}>{in_pattern})")
+        self.handlers[f"kind_{in_kind}"] = in_handler
+        self.compiled = re.compile("|".join(self.patterns), re.DOTALL)
+
+    # Returns a dictionary of "valNNN" (or "validle") to the value(s) found on the page
+    def parse(self, in_text):
+        values = {}
+        for match in self.compiled.finditer(in_text):
+            self.handlers[match.lastgroup](match, values)
+        return values
@@ -0,0 +1,89 @@
+#
+# This is the one pooled HTTP session used for every request to the ISG web server
+# Connections are kept alive and reused, failed requests are retried within a budget and
+# pages are revalidated with the validators from the last response so unchanged pages are not re-sent
+#
+import json
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class http_session:
+    def __init__(self, in_host, in_logger, in_timeout=10.0, in_retries=3, in_pool_size=4):
+        in_logger.debug(f"http_session __init__ {in_host} {in_timeout} {in_retries} {in_pool_size}")
+
+        self.host = in_host
+        self.logger = in_logger
+        self.timeout = in_timeout
+
+        # Only idempotent requests (not the POST to save.php) are retried by the adapter
+        retry = Retry(total=in_retries, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=in_pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+
+        # Per page - the last text received and the validators sent with it
+        self.page_text = {}
+        self.page_validators = {}
+
+    def url(self, in_path):
+        return f"http://{self.host}/{in_path}"
+
+    # Returns the text of the page or None if it could not be fetched
+    def get_page(self, in_page):
+        self.logger.debug(f"http_session get_page {in_page}")
+
+        headers = {}
+        if in_page in self.page_validators:
+            etag, last_modified = self.page_validators[in_page]
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        try:
+            page = self.session.get(self.url(in_page), headers=headers, timeout=self.timeout)
+        except requests.RequestException as err:
+            self.logger.error(f"http_session get_page - http get failed: {self.url(in_page)} {err}")
+            return None
+
+        if page.status_code == 304 and in_page in self.page_text:
+            self.logger.debug(f"http_session get_page {in_page} not modified")
+            return self.page_text[in_page]
+
+        if page.status_code != 200:
+            self.logger.error(f"http_session get_page - http get failed: {self.url(in_page)} "
+                              f"{page.status_code} {page.reason}")
+            return None
+
+        self.page_text[in_page] = page.text
+        self.page_validators[in_page] = (page.headers.get("ETag"), page.headers.get("Last-Modified"))
+
+        return page.text
+
+    # Forget what we know about a page so the next get fetches it in full
+    def invalidate(self, in_page):
+        self.page_text.pop(in_page, None)
+        self.page_validators.pop(in_page, None)
+
+    # Saves a single "valNNN" value
+    # This is the equivalent of the curl command line:
+    # curl http://servicewelt/save.php --data-urlencode 'data=[{"name":"val22","value":"46.5"}]'
+    def save_value(self, in_name, in_value):
+        self.logger.debug(f"http_session save_value {in_name} {in_value}")
+
+        data = {"data": json.dumps([{"name": in_name, "value": str(in_value)}], separators=(",", ":"))}
+        try:
+            response = self.session.post(self.url("save.php"), data=data, timeout=self.timeout)
+        except requests.RequestException as err:
+            self.logger.error(f"http_session save_value failed: {in_name} {in_value} {err}")
+            return False
+
+        if response.status_code != 200:
+            self.logger.error(f"http_session save_value failed: {in_name} {in_value} "
+                              f"{response.status_code} {response.reason}")
+            return False
+
+        return True
@@ -1,136 +1,327 @@
 #
 # This contains all of the modbus related functionality
 #
-from easymodbus.modbusClient import ModbusClient
 from datetime import datetime, timedelta
-import sys
+from array import array
 from isg_mysensors_constants import *
-import time
+from isg_mysensors_planner import plan_blocks
+from isg_mysensors_decoder import block_decoder
+from isg_mysensors_modbus_tcp import modbus_tcp, READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS
+from isg_mysensors_connection import connection_supervisor
+from isg_mysensors_adaptive import refresh_tracker
 
 
 class modbus:
-    def __init__(self, in_host, in_port, in_logger):
-        in_logger.debug(f"modbus __init__ {in_host}, {in_port}")
+    def __init__(self, in_host, in_port, in_logger, in_client_type=CLIENT_NATIVE, in_timeout=10.0, in_depth=4,
+                 in_reconnect_delay=1.0, in_reconnect_max_delay=300.0):
+        in_logger.debug(f"modbus __init__ {in_host}, {in_port} {in_client_type} {in_timeout} {in_depth} "
+                        f"{in_reconnect_delay} {in_reconnect_max_delay}")
 
         self.host = in_host
         self.port = in_port
         self.logger = in_logger
+        self.client_type = in_client_type
+        self.timeout = in_timeout
+        self.depth = in_depth
 
-        try:
-            self.modbus_client = ModbusClient(in_host, int(in_port))
-            self.modbus_client.connect()
-        except:
-            in_logger.critical("Failed to connect to ISG")
-            in_logger.critical(sys.exc_info()[0])
-            raise
+        # Only the native client can have several reads in flight
+        self.pipelined = in_client_type == CLIENT_NATIVE
 
         self.block_raw = {}
+        # Reads go into a second buffer per block that only takes the place of block_raw once every read
+        # has succeeded - so a failed read never leaves a block's cache part overwritten
+        self.block_scratch = {}
         self.block_start = {}
         self.block_length = {}
+        self.block_table = {}
+        self.register_block = {}
+        self.block_registers = {}
+        self.block_decoders = {}
         self.refresh_datetime = {}
         self.register_values = {}
+        # Blocks whose last read failed - their values are the last known ones
+        self.stale_blocks = set()
+        # The adaptive registers and what they have learnt about how often they change
+        self.refresh_trackers = {}
+        # Called with the list of blocks whenever blocks have new values
+        self.on_refresh = None
+        # Called with a list of blocks and True when they go stale or False when they have been read again
+        self.on_stale = None
+        # The register details the blocks were planned from
+        self.registers = {}
+
+        # If the ISG is not there we carry on and the supervisor keeps trying in the background
+        self.modbus_client = None
+        self.connection = connection_supervisor("ISG", self.connect_client, in_logger,
+                                                in_reconnect_delay, in_reconnect_max_delay)
+        self.connection.start()
+
+    def new_client(self):
+        if self.client_type == CLIENT_EASYMODBUS:
+            from easymodbus.modbusClient import ModbusClient
+            return ModbusClient(self.host, int(self.port))
+        return modbus_tcp(self.host, int(self.port), self.timeout, self.depth)
+
+    # Called by the connection supervisor (possibly from its thread) to replace the client
+    def connect_client(self):
+        self.logger.debug(f"modbus connect_client")
+
+        if self.modbus_client is not None:
+            try:
+                self.modbus_client.close()
+            except Exception:
+                pass
+
+        modbus_client = self.new_client()
+        modbus_client.connect()
+        self.modbus_client = modbus_client
 
     def run_close(self):
         self.logger.debug(f"modbus run_close")
-        self.modbus_client.close()
-
-    def build_blocks(self, in_reg_num_list):
-        self.logger.debug(f"modbus build_blocks {in_reg_num_list}")
-        # Read in from the device in blocks of max 100 in sections 501-600, 2501-2600, etc
-
-        # Build up the block details by reading through the list of registers
-        # and breaking when we find a new 100 max grouping
-        curBlock = int((int(in_reg_num_list[0]) - 1) / 100)
-        self.block_start[curBlock] = int(in_reg_num_list[0])
-        self.block_length[curBlock] = 2
-        self.refresh_datetime[curBlock] = datetime.min  # Set as old as possible so always refreshed on first read
-
-        for readNum in in_reg_num_list:
-            if readNum[0:3] == "val":
-                break
-            else:
-                reg_num = int(readNum)
-                if int((reg_num - 1) / 100) == curBlock:
-                    self.block_length[curBlock] = reg_num - int(self.block_start[curBlock]) + 2
-                else:
-                    curBlock = int((reg_num - 1) / 100)
-                    self.block_start[curBlock] = reg_num
-                    self.block_length[curBlock] = 2
-                    self.refresh_datetime[curBlock] = datetime.min
-
-    # Refresh just the block containing the register we are reading
-    # Note that the block is the first register value / 100 - eg. 5 = register 500 onwards
+        self.connection.stop()
+        if self.modbus_client is not None:
+            self.modbus_client.close()
+
+    def build_blocks(self, in_registers, in_gap_cost=defaultBlockGapCost, in_max_length=defaultBlockMaxLength):
+        self.logger.debug(f"modbus build_blocks {in_registers} {in_gap_cost} {in_max_length}")
+
+        self.registers = in_registers
+
+        # Blocks are numbered in order and each register is mapped to the block it is read in
+        for block, (table, start, length) in enumerate(plan_blocks(in_registers, in_gap_cost, in_max_length)):
+            self.logger.info(f"modbus block {block} {table} registers {start} to {start + length - 1}")
+            self.block_table[block] = table
+            self.block_start[block] = start
+            self.block_length[block] = length
+            self.refresh_datetime[block] = datetime.min  # Set as old as possible so always refreshed on first read
+            # Blocks are read in place into these buffers so they are allocated once here
+            self.block_raw[block] = array('H', bytes(2 * length))
+            self.block_scratch[block] = array('H', bytes(2 * length))
+            self.block_registers[block] = []
+            for register in in_registers.keys():
+                if start <= register < start + length:
+                    self.register_block[register] = block
+                    self.block_registers[block].append(register)
+            self.block_decoders[block] = block_decoder(start, {register: in_registers[register]
+                                                               for register in self.block_registers[block]})
+
+        for register, details in in_registers.items():
+            if details.get("adaptive") is not None:
+                self.refresh_trackers[register] = refresh_tracker(*details["adaptive"])
+
+    # Plan the blocks again for a new set of registers - a block that reads exactly the same registers
+    # in the same way as before keeps its cache and when it was read so it isn't read again straight away
+    # Returns the number of blocks kept
+    def rebuild_blocks(self, in_registers, in_gap_cost=defaultBlockGapCost, in_max_length=defaultBlockMaxLength):
+        self.logger.debug(f"modbus rebuild_blocks {in_gap_cost} {in_max_length}")
+
+        old_blocks = {(self.block_table[block], self.block_start[block], self.block_length[block]): block
+                      for block in self.block_raw.keys()}
+        old_raw = self.block_raw
+        old_refresh_datetime = self.refresh_datetime
+        old_block_registers = self.block_registers
+        old_stale_blocks = self.stale_blocks
+        old_registers = self.registers
+        old_trackers = self.refresh_trackers
+
+        self.block_raw = {}
+        self.block_scratch = {}
+        self.block_start = {}
+        self.block_length = {}
+        self.block_table = {}
+        self.register_block = {}
+        self.block_registers = {}
+        self.block_decoders = {}
+        self.refresh_datetime = {}
+        self.register_values = {}
+        self.stale_blocks = set()
+        self.refresh_trackers = {}
+        self.build_blocks(in_registers, in_gap_cost, in_max_length)
+
+        kept = 0
+        for block in self.block_raw.keys():
+            old_block = old_blocks.get((self.block_table[block], self.block_start[block], self.block_length[block]))
+            if old_block is None or old_block_registers[old_block] != self.block_registers[block]:
+                continue
+            if any((old_registers[register]["width"], old_registers[register]["data_type"]) !=
+                   (in_registers[register]["width"], in_registers[register]["data_type"])
+                   for register in self.block_registers[block]):
+                continue
+
+            self.block_raw[block][:] = old_raw[old_block]
+            self.refresh_datetime[block] = old_refresh_datetime[old_block]
+            if old_block in old_stale_blocks:
+                self.stale_blocks.add(block)
+            if self.refresh_datetime[block] != datetime.min:
+                self.decode_block(block)
+            kept += 1
+
+        # Adaptive registers carry on with what they have learnt unless their bounds have changed
+        for register, tracker in old_trackers.items():
+            if register in self.refresh_trackers and \
+                    in_registers[register]["adaptive"] == old_registers[register]["adaptive"]:
+                self.refresh_trackers[register] = tracker
+
+        return kept
+
+    # Refresh the raw data of a block and decode every register in it in one pass
     def refresh_raw_values(self, in_block):
         self.logger.debug(f"modbus refresh_raw_values {in_block}")
-        # 1500s are read / write holding registers
-        if in_block == 15:
-            try:
-                self.block_raw[in_block] = self.modbus_client.read_holdingregisters(
-                                            self.block_start[in_block]-1, self.block_length[in_block])
-            except Exception:
-                self.logger.error(f"modbus refresh_raw_values failed to read - probably a timeout")
-                self.reconnect()
-                self.refresh_raw_values(in_block)
-        else:
-            try:
-                self.block_raw[in_block] = self.modbus_client.read_inputregisters(
-                                            self.block_start[in_block]-1, self.block_length[in_block])
-            except Exception:
-                self.logger.error(f"modbus refresh_raw_values failed to read - probably a timeout")
-                self.reconnect()
-                self.refresh_raw_values(in_block)
 
-        self.refresh_datetime[in_block] = datetime.now()
+        self.refresh_blocks([in_block])
 
         return
 
-    def reconnect(self):
-        self.logger.debug(f"modbus reconnect")
+    def read_block(self, in_block):
+        if self.block_table[in_block] == TABLE_HOLDING:
+            registers = self.modbus_client.read_holdingregisters(self.block_start[in_block]-1,
+                                                                 self.block_length[in_block])
+        else:
+            registers = self.modbus_client.read_inputregisters(self.block_start[in_block]-1,
+                                                               self.block_length[in_block])
+        self.block_scratch[in_block][:] = array('H', registers)
 
-        connected = 0
+    # Refresh several blocks at once - with the native client all of the reads are pipelined
+    # The blocks are read into their scratch buffers which are swapped with the caches once all of the reads
+    # have succeeded - if any fails the caches keep their last values and the blocks are marked as stale
+    def refresh_blocks(self, in_blocks):
+        self.logger.debug(f"modbus refresh_blocks {in_blocks}")
 
-        while connected == 0:
-            time.sleep(30.0)
-            self.logger.info(f"Attempting to reconnect to ISG")
-            try:
-                self.modbus_client = ModbusClient(self.host, int(self.port))
-                self.modbus_client.connect()
-                connected = 1
-            except:
-                self.logger.error("Failed to connect to ISG")
-                self.logger.error(sys.exc_info()[0])
+        if not in_blocks:
+            return
+
+        if not self.connection.available():
+            self.mark_stale(in_blocks)
+            return
+
+        try:
+            if self.pipelined:
+                self.modbus_client.read_pipelined(
+                    [(READ_HOLDING_REGISTERS if self.block_table[block] == TABLE_HOLDING else READ_INPUT_REGISTERS,
+                      self.block_start[block]-1, self.block_scratch[block]) for block in in_blocks])
+            else:
+                for block in in_blocks:
+                    self.read_block(block)
+        except Exception as err:
+            self.logger.error(f"modbus refresh_blocks failed to read - probably a timeout - {err}")
+            self.mark_stale(in_blocks)
+            self.connection.report_failure()
+            return
+
+        for block in in_blocks:
+            self.block_raw[block], self.block_scratch[block] = self.block_scratch[block], self.block_raw[block]
+
+        self.connection.report_success()
+        recovered = [block for block in in_blocks if block in self.stale_blocks]
+        if recovered:
+            self.logger.info(f"modbus blocks {recovered} have been read again - no longer stale")
+            self.stale_blocks.difference_update(recovered)
+            if self.on_stale is not None:
+                self.on_stale(recovered, False)
+        refresh_time = datetime.now()
+        for block in in_blocks:
+            self.refresh_datetime[block] = refresh_time
+            self.decode_block(block)
+            self.track_block(block)
+
+        if self.on_refresh is not None:
+            self.on_refresh(in_blocks)
+
+    # Mark blocks that couldn't be read as stale - only the change is logged and reported, not every failed read
+    def mark_stale(self, in_blocks):
+        newly_stale = [block for block in in_blocks if block not in self.stale_blocks]
+        if not newly_stale:
+            return
+        self.logger.warning(f"modbus blocks {newly_stale} could not be read - serving their last values as stale")
+        self.stale_blocks.update(newly_stale)
+        if self.on_stale is not None:
+            self.on_stale(newly_stale, True)
+
+    # Let the adaptive registers of a freshly read block learn whether their values have changed
+    def track_block(self, in_block):
+        for register in self.block_registers[in_block]:
+            if register in self.refresh_trackers:
+                self.refresh_trackers[register].update(self.register_values.get(register))
+
+    # The refresh to use for a register - what it has learnt if it is adaptive, otherwise the configured one
+    def effective_refresh(self, in_register, in_refresh):
+        tracker = self.refresh_trackers.get(in_register)
+        if tracker is None:
+            return in_refresh
+        return tracker.refresh
+
+    # The block caches in a form that can be saved - blocks are identified by what they read
+    # so a cache is only restored into a block of the same plan
+    def cache_state(self):
+        return [{"table": self.block_table[block], "start": self.block_start[block],
+                 "length": self.block_length[block], "raw": list(self.block_raw[block]),
+                 "read": None if self.refresh_datetime[block] == datetime.min
+                 else self.refresh_datetime[block].timestamp(),
+                 "stale": block in self.stale_blocks}
+                for block in self.block_raw.keys()]
 
-        self.logger.info(f"Reconnected to ISG")
+    # Put saved block caches back - each block is read again as soon as it is stale by its own read time
+    # Returns the number of blocks restored
+    def restore_cache(self, in_blocks):
+        self.logger.debug(f"modbus restore_cache {len(in_blocks)}")
+
+        saved = {(cache["table"], cache["start"], cache["length"]): cache for cache in in_blocks}
+        restored = 0
+        for block in self.block_raw.keys():
+            cache = saved.get((self.block_table[block], self.block_start[block], self.block_length[block]))
+            if cache is None or cache["read"] is None:
+                continue
+            self.block_raw[block][:] = array('H', cache["raw"])
+            self.refresh_datetime[block] = datetime.fromtimestamp(cache["read"])
+            if cache["stale"]:
+                self.stale_blocks.add(block)
+            self.decode_block(block)
+            restored += 1
+
+        return restored
+
+    # A register is stale if its block could not be read or has never been read
+    def register_stale(self, in_register):
+        return self.register_values.get(in_register) is None or self.register_block[in_register] in self.stale_blocks
+
+    # Seconds since the register's block was last read or None if it never has been
+    def register_age(self, in_register):
+        refresh_datetime = self.refresh_datetime[self.register_block[in_register]]
+        if refresh_datetime == datetime.min:
+            return None
+        return (datetime.now() - refresh_datetime).total_seconds()
+
+    def block_stale(self, in_block, in_refresh):
+        return datetime.now() > (self.refresh_datetime[in_block] + timedelta(seconds=in_refresh))
+
+    # Only refresh the raw data if the block raw data is stale
+    # Returns True if the block was refreshed
+    def refresh_block_if_needed(self, in_block, in_refresh):
+        self.logger.debug(f"modbus refresh_block_if_needed {in_block} {in_refresh}")
+
+        if self.block_stale(in_block, in_refresh):
+            self.refresh_raw_values(in_block)
+            return True
+
+        return False
 
     # Only refresh the raw data if the register raw data is stale
     def refresh_if_needed(self, in_register, in_refresh):
         self.logger.debug(f"modbus refresh_if_needed {in_register} {in_refresh}")
 
-        block = int((in_register - 1) / 100)
-        if datetime.now() > (self.refresh_datetime[block] + timedelta(seconds=int(in_refresh))):
-            self.refresh_raw_values(block)
+        return self.refresh_block_if_needed(self.register_block[in_register],
+                                            self.effective_refresh(in_register, in_refresh))
+
+    def decode_block(self, in_block):
+        self.logger.debug(f"modbus decode_block {in_block}")
 
+        self.register_values.update(self.block_decoders[in_block].decode(self.block_raw[in_block]))
+
+    # The block decodes every register when it is refreshed so this only has to make sure it is fresh
     def refresh_net_value(self, in_register, in_refresh, in_register_type, in_type):
         self.logger.debug(f"modbus refresh_net_value {in_register} {in_refresh} {in_register_type} {in_type}")
 
         self.refresh_if_needed(in_register, in_refresh)
-        raw_value = self.block_raw[int((in_register-1)/100)][in_register - self.block_start[int((in_register-1)/100)]]
-        # Handle sign for types 2 and 7
-        if (int(raw_value) > 32768) and \
-                (in_register_type == 2 or in_register_type == 7):
-            net_value = int(raw_value) - 65536
-        else:
-            net_value = int(raw_value)
-        net_value *= readMultiplier[in_register_type]
-
-        if in_type == 'long':
-            net_value += self.block_raw[int((in_register-1)/100)]\
-                                       [in_register - self.block_start[int((in_register-1)/100)]+1] * 1000
-
-        if readMultiplier[in_register_type] == 1:
-            self.register_values[in_register] = int(net_value)
-        else:
-            self.register_values[in_register] = round(net_value, 2)
 
         return
 
@@ -139,16 +330,66 @@ class modbus:
 
         #        print("registerValue " + str(inRegister) + " " + str(inRefresh))
         self.refresh_net_value(in_register, in_refresh, in_reg_datatype, in_type)
-        return self.register_values[in_register]
+        return self.register_values.get(in_register)
 
-    def write_register(self, in_sensor_id, in_register, in_reg_data_type, in_value):
-        self.logger.debug(f"modbus write_register {in_sensor_id} {in_register} {in_reg_data_type} {in_value}")
+    # Convert an engineering value to the raw register value - rounded as 46.5 / 0.1 is 464.99999...
+    def to_raw(self, in_reg_data_type, in_value):
+        return int(round(float(in_value) / float(readMultiplier[in_reg_data_type])))
 
-        raw_value = int(float(in_value) / float(readMultiplier[in_reg_data_type]))
+    # Write consecutive registers in one request and update the block cache at the same offsets the reads use
+    # Returns False if the write could not be made
+    def write_registers(self, in_start, in_values):
+        self.logger.debug(f"modbus write_registers {in_start} {in_values}")
 
-        self.modbus_client.write_single_register(in_register - 1, raw_value)
+        if not self.connection.available():
+            self.logger.warning(f"modbus write_registers ISG not connected - write to {in_start} delayed")
+            return False
 
-        # Make sure we update the raw data and then publish the new value
-        self.block_raw[int((in_register - 1) / 100)][in_register % 100 - 1] = raw_value
+        try:
+            if len(in_values) == 1:
+                self.modbus_client.write_single_register(in_start - 1, in_values[0])
+            else:
+                self.modbus_client.write_multiple_registers(in_start - 1, in_values)
+        except Exception as err:
+            self.logger.error(f"modbus write_registers failed to write {in_start} - {err}")
+            self.connection.report_failure()
+            return False
 
-        return
+        self.update_cache(in_start, in_values)
+
+        return True
+
+    # Put register values into the block cache and decode the blocks they are in
+    def update_cache(self, in_start, in_values):
+        blocks = set()
+        for index, raw_value in enumerate(in_values):
+            register = in_start + index
+            if register in self.register_block:
+                block = self.register_block[register]
+                self.block_raw[block][register - self.block_start[block]] = raw_value & 0xFFFF
+                blocks.add(block)
+
+        for block in blocks:
+            self.decode_block(block)
+
+        if self.on_refresh is not None and blocks:
+            self.on_refresh(list(blocks))
+
+    # Read back just the written registers and make the cache agree with what the ISG actually holds
+    # Returns True if the ISG holds the values written
+    def verify_registers(self, in_start, in_values):
+        self.logger.debug(f"modbus verify_registers {in_start} {in_values}")
+
+        try:
+            read_values = list(self.modbus_client.read_holdingregisters(in_start - 1, len(in_values)))
+        except Exception as err:
+            self.logger.error(f"modbus verify_registers failed to read {in_start} - {err}")
+            self.connection.report_failure()
+            return False
+
+        if read_values != [value & 0xFFFF for value in in_values]:
+            self.logger.warning(f"modbus verify_registers {in_start} wrote {in_values} but read {read_values}")
+            self.update_cache(in_start, read_values)
+            return False
+
+        return True
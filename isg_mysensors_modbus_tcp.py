@@ -0,0 +1,134 @@
+#
+# This is a minimal Modbus TCP client for the ISG
+# Several requests can be in flight at once on the one socket (each with its own transaction id)
+# and read responses are received straight into the caller's array('H') buffers
+#
+import socket
+import struct
+import sys
+from array import array
+
+READ_HOLDING_REGISTERS = 0x03
+READ_INPUT_REGISTERS = 0x04
+WRITE_SINGLE_REGISTER = 0x06
+WRITE_MULTIPLE_REGISTERS = 0x10
+
+# Transaction id, protocol id, length, unit id, function code and the first byte of data
+MBAP_FORMAT = ">HHHBBB"
+MBAP_LENGTH = struct.calcsize(MBAP_FORMAT)
+
+
+class ModbusException(Exception):
+    pass
+
+
+class modbus_tcp:
+    def __init__(self, in_host, in_port, in_timeout=10.0, in_depth=4, in_unit_id=1):
+        self.host = in_host
+        self.port = in_port
+        self.timeout = in_timeout
+        self.depth = max(1, in_depth)
+        self.unit_id = in_unit_id
+
+        self.socket = None
+        self.transaction = 0
+
+        # Preallocated buffers for the response headers and anything we don't want to keep
+        self.header = bytearray(MBAP_LENGTH)
+        self.header_view = memoryview(self.header)
+        self.scratch = bytearray(260)
+        self.scratch_view = memoryview(self.scratch)
+
+    def connect(self):
+        self.close()
+        self.socket = socket.create_connection((self.host, self.port), self.timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    # Send a request and return its transaction id
+    def send_request(self, in_function_code, in_data):
+        self.transaction = (self.transaction + 1) & 0xFFFF
+        frame = struct.pack(">HHHBB", self.transaction, 0, len(in_data) + 2, self.unit_id, in_function_code)
+        self.socket.sendall(frame + in_data)
+        return self.transaction
+
+    def receive_into(self, in_view):
+        received = 0
+        while received < len(in_view):
+            count = self.socket.recv_into(in_view[received:])
+            if count == 0:
+                raise ConnectionError("Modbus connection closed by the server")
+            received += count
+
+    # Receive one response and match it to the pending request with the same transaction id
+    # pending is a dictionary of transaction id to (function code, buffer or None)
+    def receive_response(self, in_pending):
+        self.receive_into(self.header_view)
+        transaction, _, length, _, function_code, first_byte = struct.unpack(MBAP_FORMAT, self.header)
+
+        # The unit id, function code and first byte have been read
+        remaining = length - 3
+        if transaction not in in_pending:
+            self.receive_into(self.scratch_view[:remaining])
+            return
+
+        request_code, buffer = in_pending.pop(transaction)
+        if function_code & 0x80:
+            raise ModbusException(f"Modbus exception {first_byte} for function {request_code}")
+        if function_code != request_code:
+            raise ModbusException(f"Modbus response function {function_code} does not match {request_code}")
+
+        if buffer is None:
+            self.receive_into(self.scratch_view[:remaining])
+            return
+
+        # For reads the first byte is the byte count and the registers follow
+        view = memoryview(buffer).cast('B')
+        if first_byte != len(view) or remaining != len(view):
+            raise ModbusException(f"Modbus response of {first_byte} bytes, expected {len(view)}")
+        self.receive_into(view)
+        view.release()
+        if sys.byteorder == 'little':
+            buffer.byteswap()
+
+    # Read several register ranges with up to depth requests in flight
+    # in_requests is a list of (function code, start address, array('H') buffer sized to the number of registers)
+    def read_pipelined(self, in_requests):
+        pending = {}
+        next_request = 0
+
+        while next_request < len(in_requests) or pending:
+            while next_request < len(in_requests) and len(pending) < self.depth:
+                function_code, start, buffer = in_requests[next_request]
+                transaction = self.send_request(function_code, struct.pack(">HH", start, len(buffer)))
+                pending[transaction] = (function_code, buffer)
+                next_request += 1
+
+            self.receive_response(pending)
+
+    def read_registers(self, in_function_code, in_start, in_quantity):
+        buffer = array('H', bytes(2 * in_quantity))
+        self.read_pipelined([(in_function_code, in_start, buffer)])
+        return buffer
+
+    def read_holdingregisters(self, in_start, in_quantity):
+        return self.read_registers(READ_HOLDING_REGISTERS, in_start, in_quantity)
+
+    def read_inputregisters(self, in_start, in_quantity):
+        return self.read_registers(READ_INPUT_REGISTERS, in_start, in_quantity)
+
+    def write_single_register(self, in_address, in_value):
+        transaction = self.send_request(WRITE_SINGLE_REGISTER, struct.pack(">HH", in_address, in_value & 0xFFFF))
+        self.receive_response({transaction: (WRITE_SINGLE_REGISTER, None)})
+
+    def write_multiple_registers(self, in_address, in_values):
+        values = array('H', [value & 0xFFFF for value in in_values])
+        if sys.byteorder == 'little':
+            values.byteswap()
+        data = struct.pack(">HHB", in_address, len(values), 2 * len(values)) + values.tobytes()
+        transaction = self.send_request(WRITE_MULTIPLE_REGISTERS, data)
+        self.receive_response({transaction: (WRITE_MULTIPLE_REGISTERS, None)})
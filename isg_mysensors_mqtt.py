@@ -3,21 +3,27 @@
 # Deals with MQTT subscribe / publish / messages / etc
 
 import json
+import queue
+import threading
+import time
+from collections import OrderedDict
 import paho.mqtt.client as mqtt
 from isg_mysensors_constants import *
+from isg_mysensors_buffer import sample_buffer
 
 
 class ISGmqtt:
 
-    def __init__(self, in_mqtt_section, in_mysensors_section, in_when_message,
-                 in_sensor_types, in_sensor_names, in_logger):
+    def __init__(self, in_mqtt_section, in_mysensors_section, in_when_message, in_sensors, in_supervisor, in_logger,
+                 in_present=True):
         in_logger.debug(f"""ISGmqtt __init__ {in_mqtt_section} {in_mysensors_section} {in_when_message} 
-                         {in_sensor_types} {in_sensor_names} {in_logger}""")
+                         {in_sensors} {in_supervisor} {in_logger} {in_present}""")
 
         self.logger = in_logger
 
         self.mqtt_client = mqtt.Client(in_mqtt_section[mqttClient], True)
         self.mqtt_client.on_connect = self.when_connect
+        self.mqtt_client.on_disconnect = self.when_disconnect
         self.mqtt_client.on_message = self.when_message
 
         self.call_when_message = in_when_message
@@ -27,14 +33,51 @@ class ISGmqtt:
 
         self.node_id = in_mysensors_section[mySensorsNodeID]
         self.node_name = in_mysensors_section[mySensorsNodeName]
+        # The topics of the node's own messages - the sensors' topics are held in their sensor_spec
+        self.node_topic = self.publish_topic + self.node_id + "/"
+        self.discover_topic = self.node_topic + "255/" + COMMAND_INTERNAL + "/0/" + I_DISCOVER_RESPONSE
+
+        # Outgoing messages waiting to be sent - key (normally the topic) to topic and payload so a newer
+        # value for a topic replaces the one still waiting (keeping its place in the queue)
+        # The sender thread sends them at no more than rate_limit messages per second (0 is unlimited)
+        self.outbound = OrderedDict()
+        self.outbound_ready = threading.Condition()
+        self.rate_limit = float(in_mqtt_section.get(mqttRateLimit, 20))
+        self.stopping = False
+
+        # Only sent whilst connected to the broker - paho reconnects in the background
+        self.connected = False
+        self.reconnect_max_delay = int(in_mqtt_section.get(mqttReconnectMaxDelay, 120))
+
+        # Values published while the broker can't be reached are kept and sent on as HISTORY batches
+        self.buffer = None
+        self.buffer_batch = int(in_mqtt_section.get(mqttBufferBatch, 50))
+        if mqttBufferFile in in_mqtt_section:
+            self.buffer = sample_buffer(in_mqtt_section[mqttBufferFile], in_logger,
+                                        int(in_mqtt_section.get(mqttBufferMaxRows, 1000000)))
+        self.history_topic = f"{self.node_topic}{PSEUDO_HISTORY}/{COMMAND_SET}/0/{V_CUSTOM}"
+
+        # Incoming messages are received on paho's network thread and handled in run_loop by the caller
+        # A SimpleQueue so wake can be called from a signal handler
+        self.inbound = queue.SimpleQueue()
 
         self.connect(in_mqtt_section[mqttHost], int(in_mqtt_section[mqttPort]), int(in_mqtt_section[mqttKeepalive]))
 
-        self.presentation(in_sensor_types, in_sensor_names)
+        # paho runs the network I/O on its own background thread
+        self.mqtt_client.loop_start()
+        # The sender is restarted if it fails - the messages still queued are sent once it is back
+        self.sender = in_supervisor.start("mqtt sender", self.send_outbound)
+
+        # After a warm restart the Controller already knows the sensors
+        if in_present:
+            self.presentation(in_sensors)
 
+    # The connection is made by paho's network thread so a broker that is down doesn't stop the daemon
+    # and if the connection is lost paho keeps trying to reconnect
     def connect(self, in_host, in_port, in_keepalive):
         self.logger.debug(f"ISGmqtt connect {in_host} {in_port} {in_keepalive}")
-        self.mqtt_client.connect(in_host, in_port, in_keepalive)
+        self.mqtt_client.reconnect_delay_set(1, self.reconnect_max_delay)
+        self.mqtt_client.connect_async(in_host, in_port, in_keepalive)
 
     # The callback for when the client receives a CONNACK response from the server.
     def when_connect(self, client, userdata, flags, rc):
@@ -44,66 +87,178 @@ class ISGmqtt:
         #        print("Connected with result code "+str(rc))
         #        print(self.config[mqttSection][mqttSubscribe]+"/#")
         self.mqtt_client.subscribe(self.subscribe)
-        self.run_loop(5)
+
+        if rc == 0:
+            self.set_connected(True)
+
+    def when_disconnect(self, client, userdata, rc):
+        self.logger.warning(f"ISGmqtt when_disconnect {rc}")
+        self.set_connected(False)
+
+    def set_connected(self, in_connected):
+        with self.outbound_ready:
+            self.connected = in_connected
+            self.outbound_ready.notify()
 
     # The callback for when a PUBLISH message is received from the server.
+    # This is on paho's thread so the message is just queued for run_loop
     def when_message(self, client, userdata, msg):
         self.logger.debug(f"ISGmqtt when_message {client} {userdata} {msg}")
-        payload = str(msg.payload.decode("UTF-8"))
-        print(msg.topic + " " + payload)
-        msg_split = msg.topic.split("/")
-        msg_node_id = msg_split[1]
-        msg_sensor_id = msg_split[2]
-        msg_command = msg_split[3]
-        msg_type = msg_split[5]
+        self.inbound.put(msg)
+
+    def handle_message(self, msg):
+        self.logger.debug(f"ISGmqtt handle_message {msg}")
+        try:
+            payload = msg.payload.decode("UTF-8")
+        except UnicodeDecodeError:
+            self.logger.warning(f"ISGmqtt handle_message ignoring undecodable payload on {msg.topic}")
+            return
 
-        self.call_when_message(msg_node_id, msg_sensor_id, msg_command, msg_type, payload)
+        # The topic is checked and routed by the caller
+        self.call_when_message(msg.topic, payload)
 
+    # Wait up to in_seconds for incoming messages and handle all of those that have arrived
+    # Like paho's loop() this returns as soon as there has been something to do
     def run_loop(self, in_seconds):
         self.logger.debug(f"ISGmqtt run_loop {in_seconds}")
-        self.mqtt_client.loop(in_seconds)
 
-    def presentation(self, in_sensor_types, in_sensor_names):
-        self.logger.debug(f"ISGmqtt presentation {in_sensor_types} {in_sensor_names}")
+        try:
+            msg = self.inbound.get(timeout=in_seconds) if in_seconds > 0 else self.inbound.get_nowait()
+        except queue.Empty:
+            return
+
+        while msg is not None:
+            self.handle_message(msg)
+            try:
+                msg = self.inbound.get_nowait()
+            except queue.Empty:
+                msg = None
+
+    # Make run_loop return straight away - eg. so a reload is done without waiting for the next sensor
+    def wake(self):
+        self.inbound.put(None)
+
+    # Queue a message for the sender thread - replacing any unsent payload for the same topic
+    # Messages on the same topic that must not replace each other are given their own in_key
+    # in_row is the buffered sample of the same value - removed once the live message is sent
+    def publish(self, in_topic, in_payload, in_key=None, in_row=None):
+        with self.outbound_ready:
+            self.outbound[in_topic if in_key is None else in_key] = (in_topic, in_payload, in_row)
+            self.outbound_ready.notify()
+
+    # Sends the queued messages whilst connected - the live messages first and then any buffered history
+    # Once stopping only the live messages are sent - the history stays in the buffer for next time
+    def send_outbound(self):
+        tokens = self.rate_limit
+        last_time = time.monotonic()
+
+        while True:
+            with self.outbound_ready:
+                while not self.stopping and not (self.connected and (self.outbound or self.buffered())):
+                    self.outbound_ready.wait()
+                if self.stopping and not (self.connected and self.outbound):
+                    return
+                if self.outbound:
+                    message = self.outbound.popitem(last=False)[1]
+                else:
+                    message = None
+
+            # Token bucket allowing bursts of up to one second's worth of messages
+            if self.rate_limit > 0:
+                current_time = time.monotonic()
+                tokens = min(self.rate_limit, tokens + (current_time - last_time) * self.rate_limit)
+                last_time = current_time
+                if tokens < 1:
+                    time.sleep((1 - tokens) / self.rate_limit)
+                    tokens = 1
+                    last_time = time.monotonic()
+                tokens -= 1
+
+            if message is not None:
+                self.send_message(*message)
+            else:
+                self.send_history()
+
+    # A value that was buffered whilst disconnected isn't sent again as history once it has gone live
+    def send_message(self, in_topic, in_payload, in_row):
+        result = self.mqtt_client.publish(in_topic, in_payload)
+        if in_row is not None and result.rc == mqtt.MQTT_ERR_SUCCESS:
+            self.buffer.remove(in_row)
+
+    def buffered(self):
+        return self.buffer is not None and self.buffer.rows > 0
+
+    # Send the oldest batch of buffered samples as [time, sensor id, value] in one message
+    # They are only removed from the buffer once paho has taken the message
+    def send_history(self):
+        samples = self.buffer.oldest(self.buffer_batch)
+        if not samples:
+            return
+
+        payload = json.dumps([[round(sample_time, 3), sensor, json.loads(value)]
+                              for _, sample_time, sensor, value in samples])
+        result = self.mqtt_client.publish(self.history_topic, payload, qos=1)
+        if result.rc != mqtt.MQTT_ERR_SUCCESS:
+            self.logger.warning(f"ISGmqtt send_history could not send - {result.rc}")
+            self.set_connected(False)
+            return
+
+        self.buffer.remove_to(samples[-1][0])
+        self.logger.debug(f"ISGmqtt send_history sent {len(samples)} - {self.buffer.rows} left")
+
+    def presentation(self, in_sensors):
+        self.logger.debug(f"ISGmqtt presentation {in_sensors}")
         # Announce the Gateway as a repeater node
         #            self.mqttClient.publish("ISG/0/255/0/0/17", "2.3.2")
-        self.mqtt_client.publish(self.publish_topic + self.node_id + "/255/0/0/17", "2.3.2")
+        self.publish(self.node_topic + "255/0/0/17", "2.3.2")
         #            self.mqttClient.publish("ISG/0/255/0/0/18", "1.2.3")
-        self.mqtt_client.publish(self.publish_topic + self.node_id + "/255/0/0/18", softwareVersion)
+        self.publish(self.node_topic + "255/0/0/18", softwareVersion)
 
         # Announce the "sketch" and "version"
         #            self.mqttClient.publish("ISG/0/255/3/0/11", "ISG Node")
-        self.mqtt_client.publish(self.publish_topic + self.node_id + "/255/3/0/11", self.node_name)
+        self.publish(self.node_topic + "255/3/0/11", self.node_name)
         #            self.mqttClient.publish("ISG/0/255/3/0/12", "1.2.3")
-        self.mqtt_client.publish(self.publish_topic + self.node_id + "/255/3/0/12", softwareVersion)
+        self.publish(self.node_topic + "255/3/0/12", softwareVersion)
 
-        # Announce all of the sensors
-        #            self.mqttClient.publish("ISG/100/0/0/0/6", "Outside temp")
-        for sensor_id in in_sensor_names.keys():
-            self.mqtt_client.publish(self.publish_topic + self.node_id + "/" +
-                                     str(sensor_id) + "/0/0/" + in_sensor_types[sensor_id],
-                                     in_sensor_names[sensor_id])
+        self.present_sensors(in_sensors)
 
-        self.run_loop(5)
+    # Announce the sensors - all of them or just those that are new after a reload
+    def present_sensors(self, in_sensors):
+        self.logger.debug(f"ISGmqtt present_sensors {in_sensors}")
+        #            self.mqttClient.publish("ISG/100/0/0/0/6", "Outside temp")
+        for sensor in in_sensors.values():
+            self.publish(sensor.presentation_topic, sensor.name)
 
     def discover_response(self):
         self.logger.debug(f"ISGmqtt discover_response")
     #            self.mqttClient.publish("ISG/0/255/3/0/21", 0)
-        self.mqtt_client.publish(self.publish_topic + self.node_id + "/255/" +
-                                 COMMAND_INTERNAL + "/0/" + I_DISCOVER_RESPONSE, self.node_id)
+        self.publish(self.discover_topic, self.node_id)
 
-    def publish_value(self, in_sensor, in_variable_type, in_sensor_value):
-        self.logger.debug(f"ISGmqtt publish_value {in_sensor} {in_variable_type} {in_sensor_value}")
-        self.mqtt_client.publish(self.publish_topic + self.node_id + "/" + str(in_sensor) + "/1/0/" + in_variable_type,
-                                 in_sensor_value)
+    # in_sensor is the sensor_spec - its topic is worked out when the config is loaded
+    # Whilst disconnected (including before the first connection) the latest value waits to be sent and
+    # every value is kept in the buffer - the buffered copy of the latest value goes once it is sent live
+    def publish_value(self, in_sensor, in_sensor_value):
+        self.logger.debug(f"ISGmqtt publish_value {in_sensor} {in_sensor_value}")
+        row = None
+        if self.buffer is not None and not self.connected:
+            row = self.buffer.append(time.time(), in_sensor.key, json.dumps(in_sensor_value))
+        self.publish(in_sensor.value_topic, in_sensor_value, in_row=row)
 
-    def send_control_message(self, in_pseudo_sensor, in_command, in_payload):
-        self.logger.debug(f"ISGmqtt send_control_message {in_pseudo_sensor} {in_command} {in_payload}")
+    def send_control_message(self, in_pseudo_sensor, in_command, in_payload, in_key=None):
+        self.logger.debug(f"ISGmqtt send_control_message {in_pseudo_sensor} {in_command} {in_payload} {in_key}")
 
-        # 48 is V_CUSTOM - only used for this message
-        self.mqtt_client.publish(f"{self.publish_topic}{self.node_id}/{in_pseudo_sensor}/{in_command}/0/48",
-                                 json.dumps(in_payload))
+        # V_CUSTOM is only used for these messages
+        self.publish(f"{self.node_topic}{in_pseudo_sensor}/{in_command}/0/{V_CUSTOM}",
+                     json.dumps(in_payload), in_key)
 
+    # Send whatever is still queued and then stop the network thread
     def run_stop(self):
         self.logger.debug(f"ISGmqtt run_stop")
-        self.mqtt_client.stop_loop()
+        with self.outbound_ready:
+            self.stopping = True
+            self.outbound_ready.notify()
+        self.sender.join()
+        self.mqtt_client.disconnect()
+        self.mqtt_client.loop_stop()
+        if self.buffer is not None:
+            self.buffer.close()
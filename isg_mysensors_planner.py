@@ -0,0 +1,68 @@
+#
+# This plans the Modbus read blocks
+# Given the registers we need and how often each is needed, work out the set of read spans
+# that minimises the cost of reading them all - where each read has a fixed round trip cost
+# and every register in the span (including unused ones in gaps) adds a small extra cost
+#
+
+# Modbus limits a single read to 125 registers
+MODBUS_MAX_READ = 125
+
+
+# Cost per second of reading the span of registers in_length long every in_period seconds
+# The round trip is the unit cost and in_gap_cost is the cost of each register read
+def span_cost(in_length, in_period, in_gap_cost):
+    return (1 + in_gap_cost * in_length) / in_period
+
+
+# Plan the spans for a single register table (input or holding)
+# in_needs is a sorted list of (register, width, period)
+# Returns a list of (start, length)
+def plan_table(in_needs, in_gap_cost, in_max_length):
+    # best_cost[j] is the cheapest way of reading the first j registers
+    # and best_split[j] is where the last span starts for that plan
+    best_cost = [0.0] + [float("inf")] * len(in_needs)
+    best_split = [0] * (len(in_needs) + 1)
+
+    for end in range(1, len(in_needs) + 1):
+        span_end = 0
+        period = float("inf")
+        # Walk back from this register extending the final span until it is too long
+        for start in range(end, 0, -1):
+            register, width, need_period = in_needs[start - 1]
+            span_end = max(span_end, register + width - 1)
+            length = span_end - register + 1
+            if length > in_max_length:
+                break
+            period = min(period, need_period)
+            cost = best_cost[start - 1] + span_cost(length, period, in_gap_cost)
+            if cost < best_cost[end]:
+                best_cost[end] = cost
+                best_split[end] = start - 1
+
+    spans = []
+    end = len(in_needs)
+    while end > 0:
+        start = best_split[end]
+        first = in_needs[start][0]
+        last = max(register + width - 1 for register, width, _ in in_needs[start:end])
+        spans.append((first, last - first + 1))
+        end = start
+    spans.reverse()
+
+    return spans
+
+
+# in_registers is a dictionary of register number to {"width", "period", "table"}
+# Returns a list of (table, start, length) with the spans of each table in register order
+def plan_blocks(in_registers, in_gap_cost, in_max_length=MODBUS_MAX_READ):
+    in_max_length = min(in_max_length, MODBUS_MAX_READ)
+
+    blocks = []
+    for table in sorted(set(details["table"] for details in in_registers.values())):
+        needs = sorted((register, details["width"], details["period"])
+                       for register, details in in_registers.items() if details["table"] == table)
+        for start, length in plan_table(needs, in_gap_cost, in_max_length):
+            blocks.append((table, start, length))
+
+    return blocks
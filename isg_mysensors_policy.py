@@ -0,0 +1,37 @@
+#
+# This decides whether a new sensor value is worth publishing
+# A value is published when it has moved outside its deadband (absolute or relative to the last published value)
+# but no more often than the minimum interval, and is re-sent as a heartbeat if it has been silent too long
+#
+
+
+class publish_policy:
+    def __init__(self, in_deadband=0.0, in_deadband_percent=0.0, in_min_interval=0.0, in_heartbeat=0.0):
+        self.deadband = in_deadband
+        self.deadband_percent = in_deadband_percent
+        self.min_interval = in_min_interval
+        self.heartbeat = in_heartbeat
+
+    def __repr__(self):
+        return (f"publish_policy({self.deadband}, {self.deadband_percent}, "
+                f"{self.min_interval}, {self.heartbeat})")
+
+    # in_last_value and in_last_time are of the last value published - in_last_time is None if never published
+    def should_publish(self, in_last_value, in_last_time, in_new_value, in_time):
+        if in_last_time is None:
+            return True
+
+        silence = in_time - in_last_time
+        if 0 < self.heartbeat <= silence:
+            return True
+
+        if in_new_value == in_last_value or silence < self.min_interval:
+            return False
+
+        if isinstance(in_new_value, (int, float)) and isinstance(in_last_value, (int, float)):
+            threshold = max(self.deadband, abs(in_last_value) * self.deadband_percent / 100)
+            # Allow for float rounding so a deadband of 0.1 holds back a change of 0.1
+            if threshold > 0 and abs(in_new_value - in_last_value) <= threshold + 1e-9:
+                return False
+
+        return True
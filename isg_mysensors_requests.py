@@ -0,0 +1,41 @@
+#
+# This collects the REQs from the Controller so a burst of them (eg. when the Controller restarts)
+# is answered together - the sensors are grouped by Modbus block / web page and each group read once
+# The window starts with the first REQ of a batch so no REQ waits more than the window
+#
+import threading
+
+
+class request_batch:
+    def __init__(self, in_logger, in_window=0.2):
+        in_logger.debug(f"request_batch __init__ {in_window}")
+
+        self.logger = in_logger
+        self.window = in_window
+
+        # Sensors waiting to be answered - REQs may arrive on more than one thread
+        self.sensors = set()
+        self.due_time = None
+        self.lock = threading.Lock()
+
+    def add(self, in_sensor, in_time):
+        with self.lock:
+            if self.due_time is None:
+                self.due_time = in_time + self.window
+            self.sensors.add(in_sensor)
+
+    # Time the batch is due or None if there are no REQs waiting
+    def next_due(self):
+        return self.due_time
+
+    # Returns the sensors to be answered if the batch is due at in_time
+    def pop_due(self, in_time):
+        with self.lock:
+            if self.due_time is None or self.due_time > in_time:
+                return []
+            sensors = sorted(self.sensors)
+            self.sensors.clear()
+            self.due_time = None
+
+        self.logger.debug(f"request_batch pop_due {in_time} {sensors}")
+        return sensors
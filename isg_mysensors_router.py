@@ -0,0 +1,56 @@
+#
+# This routes inbound MySensors messages to their handlers
+# Topics are "<prefix>/<node id>/<sensor id>/<command>/<ack>/<type>" and are looked up in a table
+# keyed on node, command and type that is built once, so each message is one split and one or two lookups
+#
+
+# Number of parts in a MySensors MQTT topic
+TOPIC_PARTS = 6
+
+
+class topic_router:
+    def __init__(self, in_logger):
+        in_logger.debug(f"topic_router __init__")
+
+        self.logger = in_logger
+
+        # (node id, command, type) to handler - a type of None matches any type
+        # Handlers are called with the sensor id, type and payload
+        self.routes = {}
+
+    def add_route(self, in_node_id, in_command, in_type, in_handler):
+        self.logger.debug(f"topic_router add_route {in_node_id} {in_command} {in_type} {in_handler.__name__}")
+        self.routes[(in_node_id, in_command, in_type)] = in_handler
+
+    # Returns (node id, sensor id, command, type) or None if the topic is not a MySensors topic
+    def parse(self, in_topic):
+        parts = in_topic.split("/")
+        if len(parts) != TOPIC_PARTS or not all(parts[1:]):
+            self.logger.warning(f"topic_router ignoring malformed topic {in_topic}")
+            return None
+        return parts[1], parts[2], parts[3], parts[5]
+
+    def handler(self, in_message):
+        node_id, sensor_id, command, msg_type = in_message
+        handler = self.routes.get((node_id, command, msg_type))
+        if handler is None:
+            handler = self.routes.get((node_id, command, None))
+        return handler
+
+    # Call the handler of a parsed message - returns False if there isn't one
+    def dispatch(self, in_message, in_payload):
+        self.logger.debug(f"topic_router dispatch {in_message} {in_payload}")
+
+        handler = self.handler(in_message)
+        if handler is None:
+            self.logger.debug(f"topic_router no route for {in_message}")
+            return False
+
+        handler(in_message[1], in_message[3], in_payload)
+        return True
+
+    def route(self, in_topic, in_payload):
+        message = self.parse(in_topic)
+        if message is None:
+            return False
+        return self.dispatch(message, in_payload)
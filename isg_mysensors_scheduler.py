@@ -0,0 +1,128 @@
+#
+# This contains the publish scheduler
+# Sensors are held in a priority queue ordered by the time they are next due
+# so each tick only has to pop the sensors that are due rather than scan them all
+#
+import heapq
+import itertools
+from datetime import datetime, timedelta
+
+
+# Returns the epoch time of the next occurrence of the wall clock time "HH:MM[:SS]" after in_time
+def next_wall_time(in_publish_time, in_time):
+    if in_publish_time.count(":") == 1:
+        wall_time = datetime.strptime(in_publish_time.strip(), "%H:%M").time()
+    else:
+        wall_time = datetime.strptime(in_publish_time.strip(), "%H:%M:%S").time()
+
+    current = datetime.fromtimestamp(in_time)
+    next_time = datetime.combine(current.date(), wall_time)
+    if next_time.timestamp() <= in_time:
+        next_time = datetime.combine(current.date() + timedelta(days=1), wall_time)
+
+    return next_time.timestamp()
+
+
+class scheduler:
+    # in_name says which loop or source the schedule is for when its jitter is reported
+    def __init__(self, in_logger, in_name):
+        in_logger.debug(f"scheduler __init__ {in_name}")
+
+        self.logger = in_logger
+        self.name = in_name
+
+        # Heap of [due time, sequence, sensor]
+        # The sequence keeps the ordering stable for sensors due at the same time
+        self.queue = []
+        self.sequence = itertools.count()
+
+        # Either a number of seconds or a "HH:MM:SS" string per sensor
+        self.intervals = {}
+        self.publish_times = {}
+        # Current due time for each sensor - entries in the heap that don't match are stale and skipped
+        self.due_times = {}
+
+        # Jitter is how late a sensor was popped compared to when it was due
+        self.jitter_count = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+        self.jitter_last = 0.0
+
+    def add_interval(self, in_sensor, in_interval, in_first_time):
+        self.logger.debug(f"scheduler add_interval {in_sensor} {in_interval} {in_first_time}")
+
+        self.intervals[in_sensor] = int(in_interval)
+        self.push(in_sensor, in_first_time)
+
+    def add_publish_time(self, in_sensor, in_publish_time, in_first_time):
+        self.logger.debug(f"scheduler add_publish_time {in_sensor} {in_publish_time} {in_first_time}")
+
+        # Validate the time now rather than on the first reschedule
+        next_wall_time(in_publish_time, in_first_time)
+        self.publish_times[in_sensor] = in_publish_time
+        self.push(in_sensor, in_first_time)
+
+    # Stop scheduling a sensor - its entry in the heap is left to be discarded as stale
+    def remove(self, in_sensor):
+        self.logger.debug(f"scheduler remove {in_sensor}")
+
+        self.due_times.pop(in_sensor, None)
+        self.intervals.pop(in_sensor, None)
+        self.publish_times.pop(in_sensor, None)
+
+    def push(self, in_sensor, in_due_time):
+        self.due_times[in_sensor] = in_due_time
+        heapq.heappush(self.queue, [in_due_time, next(self.sequence), in_sensor])
+
+    # Drop heap entries that have been superseded so the head is always live
+    def discard_stale(self):
+        while self.queue and self.due_times.get(self.queue[0][2]) != self.queue[0][0]:
+            heapq.heappop(self.queue)
+
+    # Time the next sensor is due or None if nothing is scheduled
+    def next_due(self):
+        self.discard_stale()
+        if self.queue:
+            return self.queue[0][0]
+        return None
+
+    # How far behind the schedule is at in_time - the lateness of the most overdue sensor
+    def lag(self, in_time):
+        next_due = self.next_due()
+        if next_due is None:
+            return 0.0
+        return max(in_time - next_due, 0.0)
+
+    def next_time(self, in_sensor, in_time):
+        if in_sensor in self.publish_times:
+            return next_wall_time(self.publish_times[in_sensor], in_time)
+        return in_time + self.intervals[in_sensor]
+
+    # Pop all of the sensors due at or before in_time and reschedule them from in_time
+    def pop_due(self, in_time):
+        due_sensors = []
+
+        self.discard_stale()
+        while self.queue and self.queue[0][0] <= in_time:
+            due_time, _, sensor = heapq.heappop(self.queue)
+            self.record_jitter(in_time - due_time)
+            due_sensors.append(sensor)
+            self.push(sensor, self.next_time(sensor, in_time))
+            self.discard_stale()
+
+        self.logger.debug(f"scheduler pop_due {in_time} {due_sensors}")
+        return due_sensors
+
+    def record_jitter(self, in_lateness):
+        self.jitter_count += 1
+        self.jitter_total += in_lateness
+        self.jitter_last = in_lateness
+        if in_lateness > self.jitter_max:
+            self.jitter_max = in_lateness
+
+    def jitter_stats(self):
+        mean = self.jitter_total / self.jitter_count if self.jitter_count else 0.0
+        return {"count": self.jitter_count,
+                "mean": round(mean, 3),
+                "max": round(self.jitter_max, 3),
+                "last": round(self.jitter_last, 3)}
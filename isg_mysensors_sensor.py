@@ -0,0 +1,92 @@
+#
+# This is the compiled description of a sensor
+# Everything the hot paths need - where the value comes from, how it is decoded and where it is
+# published - is worked out once when the config is loaded rather than looked up on every read
+#
+from isg_mysensors_constants import *
+
+
+class sensor_spec:
+    __slots__ = ("id", "key", "name", "address", "source", "writeable", "table", "data_type", "real_type",
+                 "bit_mask", "refresh", "interval", "publish_time", "page", "sensor_type", "variable_type",
+                 "policy", "group", "priority", "expression", "adaptive", "min_refresh", "max_refresh", "block",
+                 "value_topic", "presentation_topic", "signature")
+
+    def __init__(self, in_id, in_name, in_register, in_register_type, in_table, in_data_type, in_real_type,
+                 in_bit, in_refresh, in_interval, in_publish_time, in_page, in_sensor_type, in_variable_type,
+                 in_policy, in_group=None, in_adaptive=False, in_min_refresh=None, in_max_refresh=None,
+                 in_priority=PRIORITY_NORMAL, in_expression=None):
+        self.id = in_id
+        # The sensor id as it appears in MQTT topics
+        self.key = str(in_id)
+        self.name = in_name
+
+        # Web page values are addressed by their "valNNN" name, Modbus registers by number
+        # and derived sensors are worked out from other sensors rather than read
+        self.expression = in_expression
+        if in_expression is not None:
+            self.source = SOURCE_DERIVED
+            self.address = None
+        elif in_register[0:3] == "val":
+            self.source = SOURCE_HTTP
+            self.address = in_register
+        else:
+            self.source = SOURCE_MODBUS
+            self.address = int(in_register)
+        self.writeable = in_register_type == "read/write"
+        self.table = in_table
+        self.data_type = in_data_type
+        self.real_type = in_real_type
+        self.bit_mask = 0 if in_bit is None else 1 << in_bit
+
+        self.refresh = in_refresh
+        # An adaptive sensor's register is read between every min_refresh and max_refresh seconds
+        # depending on how often its value changes - by default between Refresh and ten times Refresh
+        self.adaptive = in_adaptive
+        self.min_refresh = in_refresh if in_min_refresh is None else in_min_refresh
+        self.max_refresh = in_refresh * 10 if in_max_refresh is None else in_max_refresh
+        # Either a number of seconds or a wall clock "Publish time" - a sensor with neither isn't published
+        self.interval = in_interval
+        self.publish_time = in_publish_time
+        self.page = in_page
+
+        self.sensor_type = in_sensor_type
+        self.variable_type = in_variable_type
+        self.policy = in_policy
+        # Sensors can be put in a named group so the Controller can ask for a snapshot of just that group
+        self.group = in_group
+        # The rank of the sensor's priority - lower is more important
+        self.priority = priorityRanks[in_priority]
+
+        # Set once the Modbus blocks have been planned - the block the register is read in
+        self.block = None
+
+        # Set once the MQTT topics are known
+        self.value_topic = None
+        self.presentation_topic = None
+
+        # Everything the sensor was configured from - a reload only redoes sensors whose signature has changed
+        self.signature = None
+
+    def __repr__(self):
+        return f"sensor_spec({self.id}, {self.name}, {self.source} {self.address})"
+
+    # How often the value is actually needed - a sensor published once a day needn't be read every refresh
+    def period(self):
+        if self.publish_time is not None:
+            return max(self.refresh, 86400)
+        if self.interval is None:
+            return self.refresh
+        return max(self.refresh, self.interval)
+
+    def set_topics(self, in_publish_topic, in_node_id):
+        self.value_topic = f"{in_publish_topic}/{in_node_id}/{self.key}/1/0/{self.variable_type}"
+        self.presentation_topic = f"{in_publish_topic}/{in_node_id}/{self.key}/0/0/{self.sensor_type}"
+
+    # Convert the value decoded from the register to the value published
+    def value(self, in_reg_value):
+        if in_reg_value is None:
+            return None
+        if self.bit_mask:
+            return 1 if in_reg_value & self.bit_mask else 0
+        return in_reg_value
@@ -0,0 +1,70 @@
+#
+# This keeps a snapshot of the daemon's state in a local file so a restart can carry on where it left off
+# The file is written to a temporary file and renamed over the old one so a crash mid-write never
+# leaves a half written state behind
+#
+import json
+import os
+import time
+
+# Bump when the layout of the state changes so an old file is ignored rather than misread
+STATE_VERSION = 2
+
+
+class state_store:
+    def __init__(self, in_file_name, in_logger, in_interval=300.0, in_max_age=3600.0):
+        in_logger.debug(f"state_store __init__ {in_file_name} {in_interval} {in_max_age}")
+
+        self.file_name = in_file_name
+        self.logger = in_logger
+        self.interval = in_interval
+        # A state older than this is ignored - the ISG and the Controller have moved on too far
+        self.max_age = in_max_age
+        self.next_save = time.time() + in_interval
+
+    def save(self, in_state):
+        self.logger.debug(f"state_store save {self.file_name}")
+
+        state = {"version": STATE_VERSION, "saved": time.time()}
+        state.update(in_state)
+        temp_name = self.file_name + ".tmp"
+        try:
+            with open(temp_name, "w") as state_file:
+                json.dump(state, state_file, separators=(",", ":"))
+                state_file.flush()
+                os.fsync(state_file.fileno())
+            os.replace(temp_name, self.file_name)
+        except OSError as err:
+            self.logger.error(f"state_store could not save {self.file_name} - {err}")
+            return False
+
+        return True
+
+    # True if it is time for the periodic save
+    def save_due(self, in_time):
+        if in_time < self.next_save:
+            return False
+        self.next_save = in_time + self.interval
+        return True
+
+    # Returns the saved state or None if there isn't a usable one
+    def load(self):
+        self.logger.debug(f"state_store load {self.file_name}")
+
+        try:
+            with open(self.file_name) as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            self.logger.error(f"state_store could not load {self.file_name} - {err}")
+            return None
+
+        if state.get("version") != STATE_VERSION:
+            self.logger.warning(f"state_store ignoring {self.file_name} - version {state.get('version')}")
+            return None
+        if time.time() - state.get("saved", 0) > self.max_age:
+            self.logger.info(f"state_store ignoring {self.file_name} - older than {self.max_age}s")
+            return None
+
+        return state
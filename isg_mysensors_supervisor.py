@@ -0,0 +1,75 @@
+#
+# This supervises the daemon's own components - the poll loop, the MQTT sender and the async engine's tasks
+# A component that fails is logged and restarted in-process after a short backoff so the MQTT session,
+# the caches and the schedule all carry on rather than the whole daemon being restarted from scratch
+#
+import asyncio
+import threading
+import time
+
+
+class component_supervisor:
+    def __init__(self, in_logger, in_base_delay=0.1, in_max_delay=1.0, in_healthy_time=60.0):
+        in_logger.debug(f"component_supervisor __init__ {in_base_delay} {in_max_delay} {in_healthy_time}")
+
+        self.logger = in_logger
+        self.base_delay = in_base_delay
+        self.max_delay = in_max_delay
+        # A component that has run this long since it was restarted backs off from the start again if it fails
+        self.healthy_time = in_healthy_time
+
+        # Set on SIGTERM / SIGINT - components finish what they are doing and aren't restarted
+        self.stopping = threading.Event()
+        # Component name to the number of times it has been restarted
+        self.restarts = {}
+
+    def stop(self):
+        self.logger.info(f"component_supervisor stopping")
+        self.stopping.set()
+
+    # Exponential backoff capped so a component that keeps failing doesn't spin but is never out for long
+    def restart_delay(self, in_failures):
+        return min(self.max_delay, self.base_delay * pow(2, in_failures - 1))
+
+    # Called from the except clause when a component fails - returns its consecutive failures
+    def failed(self, in_name, in_started, in_failures):
+        self.restarts[in_name] = self.restarts.get(in_name, 0) + 1
+        failures = 1 if time.monotonic() - in_started > self.healthy_time else in_failures + 1
+        self.logger.exception(f"component_supervisor {in_name} failed - restarting in "
+                              f"{self.restart_delay(failures):.1f} seconds ({self.restarts[in_name]} restarts)")
+        return failures
+
+    # Run a component until it returns, restarting it whenever it fails unless stopping
+    def run(self, in_name, in_function, *in_args):
+        self.logger.debug(f"component_supervisor run {in_name}")
+
+        failures = 0
+        while True:
+            started = time.monotonic()
+            try:
+                return in_function(*in_args)
+            except Exception:
+                failures = self.failed(in_name, started, failures)
+            if self.stopping.wait(self.restart_delay(failures)):
+                return None
+
+    # Run a component on its own thread
+    def start(self, in_name, in_function, *in_args):
+        thread = threading.Thread(target=self.run, args=(in_name, in_function) + in_args, name=in_name, daemon=True)
+        thread.start()
+        return thread
+
+    # The same for an asyncio task
+    async def run_async(self, in_name, in_coroutine_function, *in_args):
+        self.logger.debug(f"component_supervisor run_async {in_name}")
+
+        failures = 0
+        while True:
+            started = time.monotonic()
+            try:
+                return await in_coroutine_function(*in_args)
+            except Exception:
+                failures = self.failed(in_name, started, failures)
+            if self.stopping.is_set():
+                return None
+            await asyncio.sleep(self.restart_delay(failures))
@@ -0,0 +1,86 @@
+#
+# This is the Modbus write queue
+# SETs are held for a short debounce time so a burst of SETs to the same register (eg. a slider
+# being dragged) becomes one write of the latest value, and registers that are due together and
+# next to each other are written with a single write multiple registers request
+#
+
+# Modbus allows at most 123 registers in a single write multiple registers request
+MODBUS_MAX_WRITE = 123
+
+
+class write_queue:
+    def __init__(self, in_modbus, in_logger, in_debounce=0.5, in_verify=False):
+        in_logger.debug(f"write_queue __init__ {in_debounce} {in_verify}")
+
+        self.modbus = in_modbus
+        self.logger = in_logger
+        self.debounce = in_debounce
+        # A register that keeps being SET is still written at least this often
+        self.max_delay = in_debounce * 5
+        self.verify = in_verify
+
+        # Register to [raw value, set of sensor ids, time first queued, time due]
+        self.pending = {}
+
+    def add(self, in_sensor_id, in_register, in_raw_value, in_time):
+        self.logger.debug(f"write_queue add {in_sensor_id} {in_register} {in_raw_value} {in_time}")
+
+        if in_register in self.pending:
+            entry = self.pending[in_register]
+            entry[0] = in_raw_value
+            entry[1].add(in_sensor_id)
+            entry[3] = min(entry[2] + self.max_delay, in_time + self.debounce)
+        else:
+            self.pending[in_register] = [in_raw_value, {in_sensor_id}, in_time, in_time + self.debounce]
+
+    # Forget the queued SETs of sensors that are no longer configured - a register is only left
+    # queued if a sensor that is still configured was SET as well
+    def discard(self, in_sensor_ids):
+        self.logger.debug(f"write_queue discard {in_sensor_ids}")
+
+        for register, entry in list(self.pending.items()):
+            entry[1].difference_update(in_sensor_ids)
+            if not entry[1]:
+                del self.pending[register]
+
+    # Time the next write is due or None if nothing is queued
+    def next_due(self):
+        if not self.pending:
+            return None
+        return min(entry[3] for entry in self.pending.values())
+
+    # Split the sorted registers into runs of consecutive registers
+    def runs(self, in_registers):
+        runs = []
+        for register in in_registers:
+            if runs and register == runs[-1][-1] + 1 and len(runs[-1]) < MODBUS_MAX_WRITE:
+                runs[-1].append(register)
+            else:
+                runs.append([register])
+        return runs
+
+    # Write everything due at in_time and return the sensor ids whose registers were written
+    def flush(self, in_time):
+        due = sorted(register for register, entry in self.pending.items() if entry[3] <= in_time)
+        if not due:
+            return []
+
+        self.logger.debug(f"write_queue flush {in_time} {due}")
+
+        written = []
+        for run in self.runs(due):
+            values = [self.pending[register][0] for register in run]
+            if not self.modbus.write_registers(run[0], values):
+                # Leave them queued and try again after another debounce
+                for register in run:
+                    self.pending[register][3] = in_time + self.debounce
+                continue
+
+            if self.verify:
+                self.modbus.verify_registers(run[0], values)
+
+            for register in run:
+                written.extend(self.pending.pop(register)[1])
+
+        return written